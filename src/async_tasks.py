@@ -1,64 +1,207 @@
 import asyncio
+import hashlib
 import json
-import os.path
+import logging
+import os
+import time
 import uuid
 from typing import Callable
 
-from conf.config import BASE_DIR
+from pydantic import BaseModel
+
+import metrics
+from conf.config import settings
 from message_buffer import BaseMessageBuffer
+from scheduler import FairScheduler, TaskPriority, task_partition
+from result_store import (ResultStore, STATUS_QUEUED, STATUS_PROCESSING, STATUS_OK, STATUS_FAILED,
+                          STATUS_CANCELLED, STATUS_TIMED_OUT)
+from utils.hashing import file_digest
+from worker_pool import WorkerPool, TaskFailed, TaskCancelled, TaskTimedOut, task_slot
 
-mb = BaseMessageBuffer()
+logger = logging.getLogger(__name__)
 
-path_db = BASE_DIR / 'db/results.json'
+mb = BaseMessageBuffer(partition=task_partition)
 
+# imported once by the worker's fork server instead of in every task process
+WORKER_PRELOAD = ['async_tasks', 'services.handlers']
 
-def _load_json() -> dict | None:
-    if os.path.exists(path_db):
-        with open(path_db, "r", encoding='utf-8') as f:
-            data = json.load(f)
-        return data
+# safety net in case a queue notification was lost, the worker normally wakes up on events
+WAKEUP_FALLBACK_TIMEOUT = 30
 
+results = ResultStore()
 
-def get_result_task(task_id: str):
-    results_tasks = _load_json()
 
-    if results_tasks:
-        return results_tasks.get(task_id)
+def get_result_task(task_id: str):
+    return results.get_result(task_id)
 
 
 def save_results_task(task: dict):
-    results_tasks = _load_json() or {}
+    results.save(task.get("task"), task.get('result'))
+
+
+def get_task(task_id: str) -> dict | None:
+    return results.get(task_id)
+
+
+def _json_default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json')
+    return str(value)
 
-    results_tasks.update({task.get("task"): task.get('result')})
 
-    with open(path_db, "w", encoding='utf-8') as f:
-        json.dump(results_tasks, f)
+def task_fingerprint(func: Callable, kwargs: dict, inputs: list[str] | None = None) -> str:
+    data = {
+        'task': f'{func.__module__}.{func.__qualname__}',
+        'kwargs': kwargs,
+        'inputs': [file_digest(path) if os.path.exists(path) else None for path in inputs or []],
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=_json_default).encode()).hexdigest()
 
 
-def create_task(func: Callable, kwargs: dict):
+def create_task(func: Callable, kwargs: dict, owner=None,
+                coalesce: bool = False, inputs: list[str] | None = None,
+                priority: TaskPriority = TaskPriority.normal):
+    # With coalesce an identical task (same function, arguments and input file contents) that is
+    # queued or running is returned instead of enqueuing a new one.
+    if owner is None:
+        owner = kwargs.get('user_id', kwargs.get('username'))
+    fingerprint = None
+    if coalesce:
+        fingerprint = task_fingerprint(func, kwargs, inputs)
+        existing_task_id = results.find_by_fingerprint(fingerprint)
+        if existing_task_id:
+            metrics.tasks_coalesced.inc(func.__name__)
+            return uuid.UUID(existing_task_id)
+
     task_id = uuid.uuid4()
-    mb.put({'id': str(task_id), 'task': func, 'kwargs': kwargs})
+    results.set_status(str(task_id), STATUS_QUEUED, owner=owner, fingerprint=fingerprint)
+    mb.put({'id': str(task_id), 'task': func, 'kwargs': kwargs, 'owner': owner, 'priority': int(priority),
+            'created_at': time.time()})
+    metrics.tasks_created.inc(func.__name__)
     return task_id
 
 
-def execute_task(task):
-    if task:
-        return {'task': task.get('id'),
-                'result': task.get('task')(**task.get('kwargs'))}
+def is_cancelled(task_id: str) -> bool:
+    task = results.get(task_id)
+    return bool(task) and task['status'] == STATUS_CANCELLED
 
 
-async def run_async_tasks_handling():
-    while True:
-        task = mb.get()
+def cancel_task(task_id: str, owner=None) -> bool:
+    if not results.cancel(task_id, owner=owner):
+        return False
+    # wakes the worker, which stops the task process if the task is already running
+    mb.notify()
+    return True
 
-        result = execute_task(task)
-        if result:
-            save_results_task(result)
 
-        await asyncio.sleep(1)
+async def execute_task(task: dict, execution: asyncio.Task):
+    task_id, slot = task.get('id'), task_slot(task)
+    results.set_status(task_id, STATUS_PROCESSING)
+    started_at = time.monotonic()
+    status = STATUS_OK
+    try:
+        result = await execution
+        save_results_task({'task': task_id, 'result': result})
+    except TaskCancelled:
+        status = STATUS_CANCELLED
+        logger.info('Task %s (%s) was cancelled', task_id, slot)
+        return
+    except TaskTimedOut as exc:
+        status = STATUS_TIMED_OUT
+        logger.error('Task %s (%s) timed out: %s', task_id, slot, exc)
+        results.save(task_id, None, status=STATUS_TIMED_OUT, error=str(exc))
+        return
+    except TaskFailed as exc:
+        status = STATUS_FAILED
+        logger.error('Task %s (%s) failed: %s', task_id, slot, exc)
+        results.save(task_id, None, status=STATUS_FAILED, error=str(exc))
+        return
+    except Exception as exc:
+        # the task process could not be started or its result not stored, the task must not stay processing
+        status = STATUS_FAILED
+        logger.exception('Task %s (%s) could not be executed', task_id, slot)
+        results.save(task_id, None, status=STATUS_FAILED, error=f'{exc.__class__.__name__}: {exc}')
+        return
+    finally:
+        metrics.task_execution_seconds.observe(slot, status, value=time.monotonic() - started_at)
+        if status != STATUS_OK:
+            metrics.task_failures.inc(slot, status)
+
+
+async def run_async_tasks_handling():
+    loop = asyncio.get_running_loop()
+    pool = WorkerPool(settings.WORKER_CONCURRENCY, settings.WORKER_DEFAULT_CONCURRENCY,
+                      preload=WORKER_PRELOAD,
+                      timeouts=settings.WORKER_TIMEOUTS,
+                      default_timeout=settings.WORKER_DEFAULT_TIMEOUT)
+    scheduler = FairScheduler(settings.WORKER_USER_WEIGHTS)
+    # set by new messages in the queue and by finished tasks releasing their slot
+    wakeup = asyncio.Event()
+    running = set()
+
+    def has_capacity(key: tuple) -> bool:
+        slot, _, _ = key
+        return pool.has_capacity(slot)
+
+    def dispatch(task: dict):
+        key = task_partition(task)
+        estimate = scheduler.dispatched(key)
+        started_at = time.monotonic()
+        metrics.task_wait_seconds.observe(task_slot(task), value=time.time() - task.get('created_at', time.time()))
+
+        def on_done(future: asyncio.Task):
+            scheduler.finished(key, estimate, time.monotonic() - started_at)
+            running.discard(future)
+            wakeup.set()
+
+        future = asyncio.create_task(execute_task(task, pool.submit(task)))
+        running.add(future)
+        future.add_done_callback(on_done)
+
+    def on_notification():
+        try:
+            while notifications.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+        wakeup.set()
+
+    metrics.Gauge('task_queue_depth', 'Tasks waiting in the queue', collect=lambda: {(): len(mb)})
+    metrics.Gauge('tasks_running', 'Tasks being executed', ('task',),
+                  collect=lambda: {(slot,): count for slot, count in pool.running_by_slot().items()})
+    metrics_server = await metrics.serve('0.0.0.0', settings.WORKER_METRICS_PORT) \
+        if settings.WORKER_METRICS_PORT else None
+
+    notifications = mb.open_notifications()
+    loop.add_reader(notifications.fileno(), on_notification)
+    try:
+        while True:
+            wakeup.clear()
+            for task_id in pool.running_tasks():
+                if is_cancelled(task_id):
+                    pool.cancel(task_id)
+
+            task = mb.get(accept=has_capacity, rank=scheduler.rank)
+            if task and is_cancelled(task.get('id')):
+                continue
+            if task:
+                dispatch(task)
+                continue
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=WAKEUP_FALLBACK_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        loop.remove_reader(notifications.fileno())
+        notifications.close()
+        if metrics_server:
+            metrics_server.close()
+        pool.shutdown()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     try:
         asyncio.run(run_async_tasks_handling())
     except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,59 @@
+# Short-task throughput of the queue worker: enqueues TASKS no-op tasks at once and measures
+# the time until all of their results are stored, then submits them one by one to an idle
+# worker and measures the enqueue-to-result latency.
+#   cd src && python -m benchmarks.worker_throughput [tasks]
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import async_tasks
+from message_buffer import BaseMessageBuffer
+from result_store import ResultStore
+from scheduler import task_partition
+
+TASKS = 200
+LATENCY_SAMPLES = 20
+
+
+async def _wait_results(task_ids: list[str]):
+    while any(async_tasks.get_result_task(task_id) is None for task_id in task_ids):
+        await asyncio.sleep(0.005)
+
+
+async def _run(tasks: int) -> tuple[float, float]:
+    worker = asyncio.create_task(async_tasks.run_async_tasks_handling())
+    # let the worker start and go idle
+    await asyncio.sleep(2)
+
+    started = time.perf_counter()
+    # a builtin as the task keeps the measurement down to queue and process overhead
+    await _wait_results([str(async_tasks.create_task(dict, {'n': n})) for n in range(tasks)])
+    elapsed = time.perf_counter() - started
+
+    latencies = []
+    for n in range(LATENCY_SAMPLES):
+        await asyncio.sleep(0.1)
+        started = time.perf_counter()
+        await _wait_results([str(async_tasks.create_task(dict, {'n': n}))])
+        latencies.append(time.perf_counter() - started)
+
+    worker.cancel()
+    return elapsed, sum(latencies) / len(latencies)
+
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else TASKS
+    with tempfile.TemporaryDirectory() as tmp:
+        async_tasks.mb = BaseMessageBuffer(Path(tmp) / 'db.dat', partition=task_partition)
+        async_tasks.results = ResultStore(Path(tmp) / 'results.db')
+        async_tasks.WORKER_PRELOAD = ['async_tasks']
+        async_tasks.settings.WORKER_DEFAULT_CONCURRENCY = 8
+        elapsed, latency = asyncio.run(_run(tasks))
+    print(f'throughput: {tasks} tasks in {elapsed:.2f}s, {tasks / elapsed:.1f} tasks/s')
+    print(f'idle worker latency: {latency * 1000:.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
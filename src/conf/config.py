@@ -13,6 +13,62 @@ class Settings(BaseSettings):
     SECRET_KEY: str = ''
     REFRESH_KEY: str = ''
     RECOGNITION_SERVER_URI: str = ''
+    # Worker slots per task function, functions that are not listed get the default
+    WORKER_DEFAULT_CONCURRENCY: int = 1
+    WORKER_CONCURRENCY: dict[str, int] = {
+        'transcript_audio': 2,
+        'save_user_file_from_youtube': 2,
+        'extract_user_audio_from_video_file': 8,
+        'edit_user_video': 4,
+        'index_user_file': 4,
+        'generate_user_file_previews': 2,
+        'package_user_file_hls': 2,
+    }
+    # Share of worker time per task owner (user id) under fair scheduling, owners that are not listed get 1
+    WORKER_USER_WEIGHTS: dict[str, float] = {}
+    # Wall-clock limits in seconds per task function, the task process is stopped when exceeded
+    WORKER_DEFAULT_TIMEOUT: int | None = 60 * 60
+    WORKER_TIMEOUTS: dict[str, int] = {
+        'save_user_file_from_youtube': 30 * 60,
+        'extract_user_audio_from_video_file': 30 * 60,
+        'edit_user_video': 3 * 60 * 60,
+        'generate_user_file_previews': 3 * 60 * 60,
+        'package_user_file_hls': 3 * 60 * 60,
+    }
+    # Port of the worker's /metrics endpoint, 0 disables it
+    WORKER_METRICS_PORT: int = 9100
+    # Parallel ffmpeg encoders per render (0 - one per core) and the source seconds each of them encodes
+    RENDER_PARALLELISM: int = 0
+    RENDER_CHUNK_DURATION: int = 30
+    # Disk budget in bytes for encoded parts kept between renders, 0 disables reuse across renders
+    RENDER_PARTS_CACHE_SIZE: int = 10 * 1024 ** 3
+    # Disk budget in bytes for finished renders by source content and edit, 0 renders every request again
+    RENDER_CACHE_SIZE: int = 20 * 1024 ** 3
+    # HLS renditions as height: video kbps, rungs above the source height are encoded at the source height once;
+    # h264 sources are also offered untouched at their own resolution
+    HLS_RENDITIONS: dict[int, int] = {1080: 5000, 720: 2800, 360: 800}
+    HLS_SEGMENT_DURATION: int = 6
+    # YouTube metadata lookups: threads that run them and seconds a result is reused for
+    YOUTUBE_METADATA_WORKERS: int = 4
+    YOUTUBE_METADATA_TTL: int = 10 * 60
+    # Disk budget in bytes for finished YouTube downloads shared between users, and the total download rate
+    # in bytes per second over all concurrent downloads (0 - unlimited)
+    YOUTUBE_DOWNLOAD_CACHE_SIZE: int = 20 * 1024 ** 3
+    YOUTUBE_DOWNLOAD_RATE_LIMIT: int = 0
+    # Largest accepted upload in bytes, 0 - unlimited
+    UPLOAD_MAX_SIZE: int = 0
+    # Resumable upload sessions without a new chunk for this many seconds are removed
+    UPLOAD_SESSION_TTL: int = 24 * 60 * 60
+    # Browser cache lifetime in seconds for served files, they are revalidated with ETag afterwards
+    FILES_CACHE_MAX_AGE: int = 60 * 60
+    # Internal proxy location mapped to the storage directory (e.g. nginx "internal" location), when set
+    # files are sent by the proxy through X-Accel-Redirect instead of being streamed by the API
+    FILES_ACCEL_REDIRECT: str = ''
+    # Task results are dropped after TTL seconds, or oldest first once they take more than MAX_SIZE bytes
+    RESULTS_TTL: int = 7 * 24 * 60 * 60
+    RESULTS_MAX_SIZE: int = 1024 ** 3
+    # Persisted file digests kept, least recently used ones are pruned beyond this count
+    DIGESTS_MAX_ENTRIES: int = 100_000
 
     class Config:
         case_sensitive = True
@@ -0,0 +1,164 @@
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import md5
+from mimetypes import guess_type
+from urllib.parse import quote
+
+import anyio
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+from conf.config import STORAGE_DIR, settings
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class FileRangeResponse(Response):
+    # 206 Partial Content for a single byte range, read with large chunks to keep thread hops rare
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path: str, start: int, end: int, size: int, headers: dict[str, str]):
+        super().__init__(status_code=206, headers=headers)
+        self.path = path
+        self.start, self.end = start, end
+        self.headers['content-range'] = f'bytes {start}-{end}/{size}'
+        self.headers['content-length'] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        async with await anyio.open_file(self.path, mode='rb') as file:
+            await file.seek(self.start)
+            remaining = self.end - self.start + 1
+            while remaining > 0:
+                chunk = await file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            # the file was truncated while it was sent, the client sees a short body
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+class LargeFileResponse(FileResponse):
+    chunk_size = 1024 * 1024
+
+
+def _etag(stat_result: os.stat_result) -> str:
+    digest = md5(f'{stat_result.st_mtime}-{stat_result.st_size}'.encode(), usedforsecurity=False).hexdigest()
+    return f'"{digest}"'
+
+
+def _etag_matches(etag: str, header: str, weak: bool) -> bool:
+    if header.strip() == '*':
+        return True
+    for tag in header.split(','):
+        tag = tag.strip()
+        if weak and tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _not_modified_since(stat_result: os.stat_result, header: str) -> bool:
+    try:
+        return int(stat_result.st_mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _is_fresh(request: Request, stat_result: os.stat_result, etag: str) -> bool:
+    # If-None-Match takes precedence, If-Modified-Since is only looked at without it
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return _etag_matches(etag, if_none_match, weak=True)
+    if_modified_since = request.headers.get('if-modified-since')
+    return if_modified_since is not None and _not_modified_since(stat_result, if_modified_since)
+
+
+def _range_applies(request: Request, etag: str, last_modified: str) -> bool:
+    # If-Range sends the whole file when it changed since the client fetched the first part
+    if_range = request.headers.get('if-range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return if_range == last_modified
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    # a single range is served, anything else is ignored and answered with the whole file
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    else:
+        if int(last) == 0:
+            raise RangeNotSatisfiable()
+        start, end = max(0, size - int(last)), size - 1
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _accel_redirect(path: str) -> str | None:
+    # files under the storage directory are handed over to the proxy, it sends them with sendfile
+    relative = os.path.relpath(os.path.realpath(path), os.path.realpath(STORAGE_DIR))
+    if relative.startswith(os.pardir):
+        return None
+    return settings.FILES_ACCEL_REDIRECT.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+
+
+async def file_response(request: Request, path: str, media_type: str | None = None,
+                        filename: str | None = None) -> Response:
+    try:
+        stat_result = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        return Response(status_code=404)
+    if not stat.S_ISREG(stat_result.st_mode):
+        return Response(status_code=404)
+
+    media_type = media_type or guess_type(filename or path)[0] or 'application/octet-stream'
+    etag = _etag(stat_result)
+    last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+    headers = {'etag': etag, 'last-modified': last_modified, 'accept-ranges': 'bytes',
+               'cache-control': f'private, max-age={settings.FILES_CACHE_MAX_AGE}'}
+    if filename:
+        headers['content-disposition'] = f"attachment; filename*=utf-8''{quote(filename)}"
+
+    if settings.FILES_ACCEL_REDIRECT and (location := _accel_redirect(path)):
+        # ranges and conditional requests are answered by the proxy as for any static file
+        headers.pop('etag'), headers.pop('last-modified')
+        headers['x-accel-redirect'] = location
+        return Response(headers=headers, media_type=media_type)
+
+    if _is_fresh(request, stat_result, etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('range')
+    if range_header is not None and _range_applies(request, etag, last_modified):
+        try:
+            byte_range = _parse_range(range_header, stat_result.st_size)
+        except RangeNotSatisfiable:
+            headers['content-range'] = f'bytes */{stat_result.st_size}'
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            headers['content-type'] = media_type
+            return FileRangeResponse(path, *byte_range, stat_result.st_size, headers)
+
+    return LargeFileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
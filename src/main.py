@@ -1,21 +1,34 @@
+import asyncio
 import dataclasses
+import json
+import os
 import uuid
 from enum import Enum
 
-from fastapi import FastAPI, UploadFile, File, Depends, APIRouter, Query, HTTPException
+from fastapi import FastAPI, UploadFile, File, Depends, APIRouter, Query, HTTPException, Request, Path
 from fastapi.middleware.cors import CORSMiddleware
 from starlette import status
-from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
 
+import metrics
 import models
-from async_tasks import create_task, get_result_task
+from async_tasks import create_task, get_task, cancel_task, results
 from conf.config import BASE_DIR, settings
+from file_responses import file_response
 from repository import Repository
 from schemas.actions_schema import VideoEditing
+from schemas.upload_schema import UploadCreateSchema
+from scheduler import TaskPriority
 from security import router as auth_router, get_current_user, get_content_maker
 from services import handlers
 from services.handlers import transcript_audio_file, TagSchema
-from utils.video import get_youtube_video_formats, YouTubeDlOptions
+from result_store import FINISHED_STATUSES, STATUS_OK, STATUS_PROCESSING
+from task_events import TaskEvents
+from utils import uploads
+from utils.streaming import HLS_MEDIA_TYPES, HLS_NAME_PATTERN
+from utils.video import YouTubeDlOptions, AudioFormat
+from youtube_metadata import YouTubeMetadata
 
 app = FastAPI()
 
@@ -28,6 +41,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.RequestLatencyMiddleware)
+
+
+@app.exception_handler(uploads.UploadError)
+async def upload_error_handler(request: Request, exc: uploads.UploadError):
+    if isinstance(exc, uploads.UploadNotFound):
+        status_code = status.HTTP_404_NOT_FOUND
+    elif isinstance(exc, uploads.UploadIncomplete):
+        status_code = status.HTTP_409_CONFLICT
+    else:
+        status_code = status.HTTP_400_BAD_REQUEST
+    return JSONResponse(status_code=status_code, content={"detail": str(exc)})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 # private
 video_router = APIRouter(prefix='/video')
@@ -41,6 +71,12 @@ if settings.SECURITY_ENABLED:
 
 STORAGE_DIR = BASE_DIR / settings.STORAGE_NAME
 repository = Repository()
+task_events = TaskEvents(results)
+youtube_metadata = YouTubeMetadata()
+
+LONG_POLL_MAX_TIMEOUT = 60
+SSE_KEEP_ALIVE = 15
+PREVIEW_NAME_PATTERN = r'^(proxy\.mp4|thumbnails\.vtt|sprite_\d{3}\.jpg)$'
 
 
 class AvailableFormats(str, Enum):
@@ -54,24 +90,43 @@ class AvailableFormats(str, Enum):
 
 def _check_available_formats(filename: uuid.UUID):
     with repository:
-        name = repository.get_file_by_uuid(filename).name
-    format_ = name.split('.')[1]
-    if not AvailableFormats.has_value(format_):
+        file = repository.get_file_by_uuid(filename)
+        # indexed files are checked by their container, the extension is only used until the file is indexed
+        formats = file.media_info.formats if file.media_info else [file.name.split('.')[1]]
+    if not any(AvailableFormats.has_value(format_) for format_ in formats):
         raise HTTPException(status_code=422, detail=[
             {"type": "UnsupportedFormat",
              "loc": "query.filename",
-             "msg": f'Unsupported format - {format_}'},
+             "msg": f'Unsupported format - {",".join(formats)}'},
         ])
     return filename
 
 
 # Files
-@app.get("/files/{id}")
-async def get_file(id: uuid.UUID):
-    file = handlers.get_file_by_uuid(repository, id)
+@app.api_route("/files/{id}", methods=["GET", "HEAD"])
+async def get_file(request: Request, id: uuid.UUID):
+    file = await run_in_threadpool(handlers.get_file_by_uuid, repository, id)
     if not file:
         raise HTTPException(status_code=404, detail="File is not exists")
-    return FileResponse(path=file.path)
+    return await file_response(request, file.path)
+
+
+@app.api_route("/files/{id}/previews/{name}", methods=["GET", "HEAD"])
+async def get_file_preview(request: Request, id: uuid.UUID, name: str = Path(pattern=PREVIEW_NAME_PATTERN)):
+    # proxy.mp4, thumbnails.vtt and the sprite sheets it points to, generated in the background after ingest
+    path = await run_in_threadpool(handlers.get_file_preview_path, repository, id, name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Preview is not ready")
+    return await file_response(request, path)
+
+
+@app.api_route("/files/{id}/hls/{name:path}", methods=["GET", "HEAD"])
+async def get_file_hls(request: Request, id: uuid.UUID, name: str = Path(pattern=HLS_NAME_PATTERN)):
+    # master.m3u8 lists the renditions, playlists and segments are referenced relative to it
+    path = await run_in_threadpool(handlers.get_file_hls_path, repository, id, name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Stream is not ready")
+    return await file_response(request, path, media_type=HLS_MEDIA_TYPES[os.path.splitext(name)[1]])
 
 
 @file_router.delete("/{id}")
@@ -91,7 +146,7 @@ async def get_confirmation(filename: str):
 @video_router.post("/transcribing-audio-by-notes")
 async def exact_notes_from_audio(file_id: uuid.UUID = Depends(_check_available_formats),
                                  current_user=Depends(get_current_user)):
-    task_id = transcript_audio_file(repository, file_id, current_user.id)
+    task_id = await run_in_threadpool(transcript_audio_file, repository, file_id, current_user.id)
 
     if not task_id:
         raise HTTPException(status_code=404)
@@ -107,9 +162,10 @@ async def get_available_uploading_files(current_user=Depends(get_current_user)):
 
 
 @file_router.post("/")
-async def upload_file(file: UploadFile = File(), current_user: models.User = Depends(get_current_user)):
+async def upload_file(file: UploadFile = File(), hls: bool = Query(default=False),
+                      current_user: models.User = Depends(get_current_user)):
     try:
-        filename = handlers.save_user_file(repository, current_user.username, file)
+        filename = await handlers.save_user_file(repository, current_user.username, file, hls)
         return JSONResponse(content={'status': 'ok', "filename": filename})
     except models.FileError as exc:
         raise HTTPException(status_code=400, detail=[
@@ -119,6 +175,57 @@ async def upload_file(file: UploadFile = File(), current_user: models.User = Dep
         ])
 
 
+# Resumable uploads: create a session, PUT chunks at any offsets (in any order, also in parallel),
+# GET the received ranges to resume, then complete
+def _upload_content(upload_id: str, size: int) -> dict:
+    received = uploads.received_ranges(upload_id)
+    return {'uploadId': upload_id, 'size': size, 'received': received,
+            'complete': received == [(0, size)] or size == 0}
+
+
+@file_router.post("/uploads")
+async def create_upload(upload: UploadCreateSchema, current_user=Depends(get_current_user)):
+    upload_id = await run_in_threadpool(uploads.create_upload, current_user.username, upload.filename, upload.size,
+                                        upload.hls)
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=_upload_content(upload_id, upload.size))
+
+
+@file_router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: uuid.UUID, current_user=Depends(get_current_user)):
+    session = await run_in_threadpool(uploads.get_upload, str(upload_id), current_user.username)
+    return JSONResponse(content=await run_in_threadpool(_upload_content, str(upload_id), session['size']))
+
+
+@file_router.put("/uploads/{upload_id}")
+async def upload_chunk(request: Request, upload_id: uuid.UUID, offset: int = Query(ge=0),
+                       current_user=Depends(get_current_user)):
+    length = request.headers.get("content-length")
+    await handlers.receive_upload_chunk(request.stream(), str(upload_id), current_user.username, offset,
+                                        int(length) if length else None)
+    session = await run_in_threadpool(uploads.get_upload, str(upload_id), current_user.username)
+    return JSONResponse(content=await run_in_threadpool(_upload_content, str(upload_id), session['size']))
+
+
+@file_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: uuid.UUID, current_user=Depends(get_current_user)):
+    try:
+        filename = await run_in_threadpool(handlers.complete_user_upload, repository, str(upload_id),
+                                           current_user.username)
+    except models.FileError as exc:
+        raise HTTPException(status_code=400, detail=[
+            {"type": exc.__class__.__name__,
+             "loc": "file",
+             "msg": str(exc)},
+        ])
+    return JSONResponse(content={'status': 'ok', "filename": filename})
+
+
+@file_router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: uuid.UUID, current_user=Depends(get_current_user)):
+    await run_in_threadpool(uploads.abort_upload, str(upload_id), current_user.username)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
 @content_maker_video_router.post("/tag")
 async def add_tag(tag: list[TagSchema]):
     pass
@@ -137,13 +244,14 @@ async def download_video_from_youtube(link: str,
     options = YouTubeDlOptions(format=format_)
     task_id = create_task(func=handlers.save_user_file_from_youtube, kwargs={
         'link': link, "options": options,
-        'username': current_user.username})
+        'username': current_user.username}, owner=current_user.id, coalesce=True,
+                          priority=TaskPriority.batch)
     return JSONResponse(content={'taskId': str(task_id)})
 
 
 @video_router.get("/youtube/available_formats")
 async def get_available_formats(link: str):
-    formats = get_youtube_video_formats(link)
+    formats = await youtube_metadata.formats(link)
     return JSONResponse(content={"data": formats})
 
 
@@ -152,25 +260,49 @@ async def get_available_formats(link: str):
 async def crop_video_file(editing: VideoEditing,
                           filename: uuid.UUID = Depends(_check_available_formats),
                           current_user=Depends(get_current_user)):
-    task_id = create_task(func=handlers.edit_user_video, kwargs={'editing': editing,
-                                                                 'user_id': current_user.id,
-                                                                 'file_uuid': filename})
+    # the input fingerprint hashes files that are not in the digest store yet, so it is computed off the loop
+    inputs = await run_in_threadpool(handlers.get_user_file_paths, repository, filename, current_user.id)
+    task_id = await run_in_threadpool(create_task, handlers.edit_user_video, kwargs={'editing': editing,
+                                                                                     'user_id': current_user.id,
+                                                                                     'file_uuid': filename},
+                                      owner=current_user.id,
+                                      coalesce=True,
+                                      inputs=inputs)
     return JSONResponse(content={'taskId': str(task_id)})
 
 
 @video_router.post("/exacting-audio")
 async def exact_audio_from_video_file(filename: uuid.UUID = Depends(_check_available_formats),
+                                      format_: AudioFormat = Query(alias="format", default=AudioFormat.wav),
+                                      sample_rate: int | None = Query(alias="sampleRate", default=None, ge=8000,
+                                                                      le=192000),
+                                      channels: int | None = Query(default=None, ge=1, le=8),
                                       current_user=Depends(get_current_user)):
-    task_id = create_task(func=handlers.extract_user_audio_from_video_file, kwargs={'user_id': current_user.id,
-                                                                                    "file_uuid": filename})
+    # format=original copies the audio stream as it is, sampleRate and channels are converted by ffmpeg directly
+    inputs = await run_in_threadpool(handlers.get_user_file_paths, repository, filename, current_user.id)
+    task_id = await run_in_threadpool(create_task, handlers.extract_user_audio_from_video_file,
+                                      kwargs={'user_id': current_user.id,
+                                              "file_uuid": filename,
+                                              "format_": format_,
+                                              "sample_rate": sample_rate,
+                                              "channels": channels},
+                                      owner=current_user.id,
+                                      coalesce=True,
+                                      inputs=inputs,
+                                      priority=TaskPriority.interactive)
     return JSONResponse(content={'taskId': str(task_id)})
 
 
 @video_router.post("/transcribing-audio")
 async def exact_text_from_audio(filename: uuid.UUID = Depends(_check_available_formats),
                                 current_user=Depends(get_current_user)):
-    task_id = create_task(func=handlers.transcribe_text_from_audio_file, kwargs={'file_uuid': filename,
-                                                                                 'user_id': current_user.id})
+    inputs = await run_in_threadpool(handlers.get_user_file_paths, repository, filename, current_user.id)
+    task_id = await run_in_threadpool(create_task, handlers.transcribe_text_from_audio_file,
+                                      kwargs={'file_uuid': filename,
+                                              'user_id': current_user.id},
+                                      owner=current_user.id,
+                                      coalesce=True,
+                                      inputs=inputs)
 
     return JSONResponse(content={'taskId': str(task_id)})
 
@@ -187,6 +319,7 @@ class Interval:
 class NotesSegmentSchema:
     status: str
     data: list[Interval] | None
+    error: str | None = None
 
 
 def _form_intervals(notes_data: list[tuple[float, str, float]]) -> list[Interval]:
@@ -218,17 +351,81 @@ def _form_intervals(notes_data: list[tuple[float, str, float]]) -> list[Interval
 
 @video_router.get("/notes_segment/{task_id}", response_model=NotesSegmentSchema)
 async def get_notes_segment(task_id: str):
-    result = get_result_task(task_id)
-    intervals = [dataclasses.asdict(interval) for interval in _form_intervals(result)] if result else None
-    return NotesSegmentSchema(**{'status': 'ok' if result else 'processing',
-                                 'data': intervals})
+    task = get_task(task_id)
+    if not task:
+        return NotesSegmentSchema(status=STATUS_PROCESSING, data=None)
+    intervals = None
+    if task['status'] == STATUS_OK and task['result']:
+        intervals = [dataclasses.asdict(interval) for interval in _form_intervals(task['result'])]
+    return NotesSegmentSchema(status=task['status'], data=intervals, error=task['error'])
 
 
 # Get tasks result
+def _task_result_content(task: dict | None) -> dict:
+    if not task:
+        return {'status': 'processing', 'result': None, 'error': None, 'progress': None}
+    return {'status': task['status'], 'result': task['result'], 'error': task['error'], 'progress': task['progress']}
+
+
 @video_router.get("/tasks/result")
 async def get_task_result(task_id: str = Query(alias="taskId")):
-    result = get_result_task(task_id)
-    return JSONResponse(content={'status': 'ok' if result else 'processing', 'result': result})
+    return JSONResponse(content=_task_result_content(get_task(task_id)))
+
+
+@video_router.get("/tasks/result/wait")
+async def wait_task_result(task_id: str = Query(alias="taskId"),
+                           timeout: float = Query(default=30, gt=0, le=LONG_POLL_MAX_TIMEOUT)):
+    task = await task_events.wait(task_id, timeout)
+    return JSONResponse(content=_task_result_content(task))
+
+
+@video_router.delete("/tasks/{task_id}")
+async def delete_task(task_id: str, current_user=Depends(get_current_user)):
+    if not cancel_task(task_id, owner=current_user.id):
+        task = get_task(task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="Task is not exists")
+        raise HTTPException(status_code=409, detail=f"Task can not be cancelled, status - {task['status']}")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_task_events(task_id: str | None = None, owner=None):
+    async with task_events.subscribe(task_id=task_id, owner=owner) as queue:
+        if task_id:
+            task = get_task(task_id)
+            if task:
+                yield _sse('status', {'taskId': task_id, 'status': task['status'], 'progress': task['progress']})
+                if task['status'] in FINISHED_STATUSES:
+                    return
+
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), SSE_KEEP_ALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            yield _sse('status', {'taskId': event['task_id'], 'status': event['status'],
+                                  'progress': event['progress']})
+            if task_id and event['status'] in FINISHED_STATUSES:
+                return
+
+
+@video_router.get("/tasks/events")
+async def get_user_task_events(current_user=Depends(get_current_user)):
+    return StreamingResponse(_stream_task_events(owner=current_user.id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@video_router.get("/tasks/{task_id}/events")
+async def get_task_events(task_id: str):
+    return StreamingResponse(_stream_task_events(task_id=task_id), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 app.include_router(video_router)
 app.include_router(auth_router)
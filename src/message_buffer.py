@@ -1,58 +1,239 @@
+import fcntl
+import heapq
+import itertools
 import os
 import pickle
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Callable, Hashable
 
 from conf.config import BASE_DIR
 
 path_db = BASE_DIR / 'db/db.dat'
 
+# The queue file is an append-only journal of pickled records:
+#   {"op": "put", "id": ..., "score": ..., "values": ...} - enqueued message
+#   {"op": "ack", "id": ...}                              - message was dequeued
+# Records written by the previous format ({"score": ..., "values": ...}) are read as puts.
+OP_PUT = 'put'
+OP_ACK = 'ack'
 
-def load_all(filename):
-    if not os.path.exists(filename):
-        return []
-    with open(filename, "rb") as f:
-        while True:
-            try:
-                yield pickle.load(f)
-            except EOFError:
-                break
+# Compaction starts when dead records outnumber both this value and live messages
+COMPACT_MIN_GARBAGE = 1000
 
+# Compaction bumps the generation stored next to the journal, offsets of readers are only valid within one
+# generation; inode numbers can not tell the files apart, the filesystem reuses them
+GENERATION_SUFFIX = '.gen'
 
-def write_dat(data):
-    with open(path_db, 'ab') as wf:
-        pickle.dump(data, wf)
 
+def load_all(f):
+    while True:
+        try:
+            record = pickle.load(f)
+        except EOFError:
+            break
+        except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+            # torn record at the tail, e.g. the writer was killed mid-append
+            break
+        yield record, f.tell()
 
-def clear_dat():
-    with open(path_db, 'rb+') as file:
-        file.truncate(0)
+
+def write_dat(path, data) -> int:
+    with open(path, 'ab') as wf:
+        pickle.dump(data, wf)
+        return wf.tell()
 
 
 class BaseMessageBuffer:
+    def __init__(self, path=path_db,
+                 partition: Callable[[dict], Hashable] | None = None,
+                 compact_min_garbage: int = COMPACT_MIN_GARBAGE):
+        self.path = str(path)
+        self.partition = partition or (lambda values: None)
+        self.compact_min_garbage = compact_min_garbage
+        self._lock_path = f'{self.path}.lock'
+        self._notify_path = f'{self.path}.sock'
+        self._generation_path = f'{self.path}{GENERATION_SUFFIX}'
+        self._mutex = threading.RLock()
+        self._compaction: threading.Thread | None = None
+        self._reset()
+
     def put(self, message: dict,
             updated_at: datetime | None = None):
         score = updated_at.timestamp() if updated_at else datetime.now().timestamp()
-        self._put({"score": score, "values": message})
-
-    def get(self) -> dict | None:
+        self._put({"op": OP_PUT, "id": uuid.uuid4().hex, "score": score, "values": message})
 
-        message = self._get()
+    def get(self, accept: Callable[[Hashable], bool] | None = None,
+            rank: Callable[[Hashable, tuple], tuple] | None = None) -> dict | None:
+        # accept filters partitions, rank orders the heads of accepted partitions (oldest first by default)
+        message = self._get(accept, rank)
         if message:
             return message["values"]
 
-    def _put(self, data: dict):
-        write_dat(data)
+    def __len__(self):
+        with self._mutex, self._file_lock(fcntl.LOCK_SH):
+            self._sync()
+            return len(self._messages)
+
+    def compact(self):
+        with self._mutex, self._file_lock(fcntl.LOCK_EX):
+            self._sync()
+            if self._generation is None:
+                return
+            tmp_path = f'{self.path}.compact'
+            with open(tmp_path, 'wb') as wf:
+                for _, _, message_id in sorted(itertools.chain(*self._heaps.values())):
+                    if message_id in self._messages:
+                        pickle.dump(self._messages[message_id], wf)
+                wf.flush()
+                os.fsync(wf.fileno())
+                offset = wf.tell()
+            # bumped first: after a crash in between readers only re-read the old journal from the start
+            generation = self._generation + 1
+            self._write_generation(generation)
+            os.replace(tmp_path, self.path)
+
+            for key, heap in list(self._heaps.items()):
+                heap[:] = [item for item in heap if item[2] in self._messages]
+                heapq.heapify(heap)
+                if not heap:
+                    del self._heaps[key]
+            self._generation = generation
+            self._offset = offset
+            self._records = len(self._messages)
+
+    def open_notifications(self) -> socket.socket:
+        # A consumer binds this socket and becomes readable after every put, from any process
+        if os.path.exists(self._notify_path):
+            os.remove(self._notify_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.bind(self._notify_path)
+        listener.setblocking(False)
+        return listener
 
-    def _get(self) -> dict | None:
-        queue = list(load_all(path_db))
-        if not queue:
-            return None
-        queue.sort(key=lambda n: n["score"])
-        data = queue.pop(0)
-
-        clear_dat()
-        for queue_elem in queue:
-
-            self._put(queue_elem)
+    def _put(self, data: dict):
+        with self._file_lock(fcntl.LOCK_EX):
+            write_dat(self.path, data)
+        self.notify()
 
+    def notify(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notifier:
+            notifier.setblocking(False)
+            try:
+                notifier.sendto(b'1', self._notify_path)
+            except (FileNotFoundError, ConnectionRefusedError, BlockingIOError):
+                # nobody listens (consumer will read the journal on start) or a wakeup is already pending
+                pass
+
+    def _get(self, accept: Callable[[Hashable], bool] | None = None,
+             rank: Callable[[Hashable, tuple], tuple] | None = None) -> dict | None:
+        with self._mutex, self._file_lock(fcntl.LOCK_EX):
+            self._sync()
+            if self._generation is not None and os.path.getsize(self.path) > self._offset:
+                # writers append under the same lock, so leftovers past the last record are torn
+                os.truncate(self.path, self._offset)
+            heap = self._select(accept, rank)
+            if heap is None:
+                return None
+            _, _, message_id = heapq.heappop(heap)
+            data = self._messages.pop(message_id)
+
+            # we are synced and hold the lock, so our own marker is the next record
+            self._offset = write_dat(self.path, {"op": OP_ACK, "id": data["id"]})
+            self._records += 1
+
+        self._maybe_compact()
         return data
+
+    def _select(self, accept: Callable[[Hashable], bool] | None,
+                rank: Callable[[Hashable, tuple], tuple] | None) -> list | None:
+        selected, selected_rank = None, None
+        for key, heap in list(self._heaps.items()):
+            while heap and heap[0][2] not in self._messages:
+                heapq.heappop(heap)
+            if not heap:
+                del self._heaps[key]
+                continue
+            if accept is not None and not accept(key):
+                continue
+            heap_rank = rank(key, heap[0]) if rank else heap[0]
+            if selected is None or heap_rank < selected_rank:
+                selected, selected_rank = heap, heap_rank
+        return selected
+
+    def _reset(self):
+        self._heaps: dict[Hashable, list[tuple[float, int, str]]] = {}
+        self._messages: dict[str, dict] = {}
+        self._seq = itertools.count()
+        self._offset = 0
+        self._generation = None
+        self._records = 0
+
+    def _sync(self):
+        # Reads records appended since the last sync, starting over if the journal was replaced
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            self._reset()
+            return
+        generation = self._read_generation()
+        if generation != self._generation or size < self._offset:
+            self._reset()
+            self._generation = generation
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            offset = self._offset
+            for record, end in load_all(f):
+                self._apply(record, offset)
+                offset = end
+                self._records += 1
+            self._offset = offset
+
+    def _apply(self, record: dict, offset: int):
+        op = record.get("op", OP_PUT)
+        if op == OP_ACK:
+            self._messages.pop(record["id"], None)
+            return
+
+        if "id" not in record:
+            record = {"op": OP_PUT, "id": f"legacy-{offset}", **record}
+        self._messages[record["id"]] = record
+        heap = self._heaps.setdefault(self.partition(record["values"]), [])
+        heapq.heappush(heap, (record["score"], next(self._seq), record["id"]))
+
+    def _read_generation(self) -> int:
+        try:
+            with open(self._generation_path) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_generation(self, generation: int):
+        tmp_path = f'{self._generation_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._generation_path)
+
+    def _maybe_compact(self):
+        garbage = self._records - len(self._messages)
+        if garbage < max(self.compact_min_garbage, len(self._messages)):
+            return
+        if self._compaction and self._compaction.is_alive():
+            return
+        self._compaction = threading.Thread(target=self.compact, daemon=True)
+        self._compaction.start()
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import threading
+import time
+from typing import Callable
+
+# Minimal Prometheus text format metrics, shared by the API and the worker process
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_registry: list['Metric'] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        return '\n'.join(lines + self.samples())
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labels, labels)} {value}'
+                for labels, value in list(self._values.items())]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, collect: Callable[[], dict[tuple, float]] | None = None, **kwargs):
+        # collect is called on scrape and returns the current values by label values
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+        self.collect = collect
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> list[str]:
+        values = self.collect() if self.collect else dict(self._values)
+        return [f'{self.name}{_format_labels(self.labels, labels)} {value}' for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # per label values: counts per bucket (not cumulative), sum, count
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, *labels, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labels, labels, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {count}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # any request gets the metrics, enough for a scraper without pulling an HTTP server into the worker
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: ' + CONTENT_TYPE.encode() + b'\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(_handle_scrape, host, port)
+
+
+class RequestLatencyMiddleware:
+    # plain ASGI, so streamed bodies pass straight through; a request is timed until its last body message
+    # or until it fails, and labeled with the route template the router matched
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status_code = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            observed = True
+            route = scope.get('route')
+            http_request_seconds.observe(scope['method'], route.path if route else 'unmatched', status_code,
+                                         value=time.perf_counter() - started_at)
+
+        async def send_observed(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            if not observed:
+                observe()
+
+
+# Queue and tasks
+tasks_created = Counter('tasks_created_total', 'Tasks put into the queue', ('task',))
+tasks_coalesced = Counter('tasks_coalesced_total', 'Task requests answered by an identical existing task', ('task',))
+task_wait_seconds = Histogram('task_wait_seconds', 'Time from enqueue to start of execution', ('task',))
+task_execution_seconds = Histogram('task_execution_seconds', 'Task execution time', ('task', 'status'))
+task_failures = Counter('task_failures_total', 'Tasks that did not finish successfully', ('task', 'status'))
+
+# API
+http_request_seconds = Histogram('http_request_duration_seconds', 'API request latency',
+                                 ('method', 'route', 'status'))
@@ -1,4 +1,7 @@
+import array
+import functools
 import uuid
+import zlib
 from uuid import UUID
 from dataclasses import dataclass
 
@@ -16,6 +19,89 @@ class SingingMistake:
     name: str
 
 
+def pack_times(ticks: list[int]) -> bytes:
+    # timestamps are delta encoded before compression, constant frame rate streams shrink to a few bytes
+    deltas = array.array('q', (tick - previous for previous, tick in zip([0, *ticks], ticks)))
+    return zlib.compress(deltas.tobytes())
+
+
+def unpack_times(data: bytes | None, timescale: int) -> list[float]:
+    if not data:
+        return []
+    deltas = array.array('q')
+    deltas.frombytes(zlib.decompress(data))
+    ticks, tick = [], 0
+    for delta in deltas:
+        tick += delta
+        ticks.append(tick / timescale)
+    return ticks
+
+
+class MediaInfo:
+    def __init__(self,
+                 duration: float,
+                 format_name: str,
+                 video_codec: str | None = None,
+                 pix_fmt: str | None = None,
+                 width: int | None = None,
+                 height: int | None = None,
+                 fps: float | None = None,
+                 rotation: int = 0,
+                 timescale: int | None = None,
+                 audio_codec: str | None = None,
+                 sample_rate: int | None = None,
+                 channels: int | None = None,
+                 frame_index: bytes | None = None,
+                 keyframe_index: bytes | None = None
+                 ):
+        self.duration = duration
+        self.format_name = format_name
+        self.video_codec = video_codec
+        self.pix_fmt = pix_fmt
+        self.width = width
+        self.height = height
+        self.fps = fps
+        # degrees players rotate the decoded frames by, the rotate tag ffmpeg reads from the display matrix
+        self.rotation = rotation
+        self.timescale = timescale
+        self.audio_codec = audio_codec
+        self.sample_rate = sample_rate
+        self.channels = channels
+        # packed presentation times of all video packets and of the keyframes, in timescale ticks
+        self.frame_index = frame_index
+        self.keyframe_index = keyframe_index
+
+    @property
+    def has_video(self) -> bool:
+        return self.video_codec is not None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio_codec is not None
+
+    @property
+    def display_width(self) -> int | None:
+        # frames turned by 90 or 270 degrees are shown with width and height swapped
+        return self.height if self.rotation % 180 == 90 else self.width
+
+    @property
+    def display_height(self) -> int | None:
+        return self.width if self.rotation % 180 == 90 else self.height
+
+    @property
+    def formats(self) -> list[str]:
+        # ffmpeg names a demuxer after all the extensions it handles, e.g. "mov,mp4,m4a,3gp,3g2,mj2"
+        return self.format_name.split(',')
+
+    @functools.cached_property
+    def frame_times(self) -> list[float]:
+        return unpack_times(self.frame_index, self.timescale)
+
+    @functools.cached_property
+    def keyframe_times(self) -> list[float]:
+        return unpack_times(self.keyframe_index, self.timescale)
+
+
 class File:
     def __init__(self,
                  name: str,
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # %%
 import argparse
+import math
 import numpy as np
 from pathlib import Path
+from keras.src.callbacks import Callback
+from progress import report_progress
 from notes_extractor.app.model import *
 from notes_extractor.app.featureExtraction import *
 from notes_extractor.app.quantization import *
@@ -10,6 +13,17 @@ from notes_extractor.app.utils import *
 from notes_extractor.app.MIDI import *
 
 
+# %%
+class PredictProgress(Callback):
+    def __init__(self, stage, total_batches):
+        super().__init__()
+        self.stage = stage
+        self.total_batches = total_batches
+
+    def on_predict_batch_end(self, batch, logs=None):
+        report_progress(self.stage, (batch + 1) / self.total_batches)
+
+
 # %%
 class SingingTranscription:
     def __init__(self):
@@ -33,10 +47,13 @@ class SingingTranscription:
         pitch_range = np.concatenate([np.zeros(1), pitch_range])
 
         """  Features extraction"""
+        report_progress("extracting features")
         X_test, _ = spec_extraction(file_name=filepath, win_size=self.window_size)
 
         """  melody predict"""
-        y_predict = model_ST.predict(X_test, batch_size=self.batch_size, verbose=1)
+        total_batches = math.ceil(len(X_test) / self.batch_size)
+        y_predict = model_ST.predict(X_test, batch_size=self.batch_size, verbose=1,
+                                     callbacks=[PredictProgress("predicting melody", total_batches)])
         y_predict = y_predict[0]  # [0]:note,  [1]:vocing
         y_shape = y_predict.shape
         num_total = y_shape[0] * y_shape[1]
@@ -89,6 +106,7 @@ def _transcript_audio(path_save: str, path_audio: str):
     ST = SingingTranscription()
 
     """ load model """
+    report_progress("loading model")
     model_ST = ST.load_model(f"{ST.PATH_PROJECT}/data/weight_ST.hdf5", TF_summary=False)
 
     """ predict note (time-freq) """
@@ -96,6 +114,7 @@ def _transcript_audio(path_save: str, path_audio: str):
     fl_note = ST.predict_melody(model_ST, path_audio)  # frame-level pitch score
 
     """ post-processing """
+    report_progress("post-processing")
     tempo = calc_tempo(path_audio)
     refined_fl_note = refine_note(fl_note, tempo)  # frame-level pitch score
 
@@ -1,7 +1,8 @@
 from sqlalchemy import (Table, MetaData,
                         create_engine, Column,
                         Integer, String,
-                        ForeignKey, UUID, Text)
+                        ForeignKey, UUID, Text,
+                        Float, LargeBinary, inspect)
 from sqlalchemy.orm import registry, relationship
 from conf.config import BASE_DIR
 import models
@@ -41,6 +42,26 @@ files = Table("files",
               Column("user_id", ForeignKey("users.id"))
               )
 
+media_info = Table("media_info",
+                   metadata,
+                   Column("id", Integer, primary_key=True, autoincrement=True),
+                   Column("file_id", ForeignKey("files.id", ondelete="CASCADE"), unique=True),
+                   Column("duration", Float),
+                   Column("format_name", String(255)),
+                   Column("video_codec", String(50)),
+                   Column("pix_fmt", String(50)),
+                   Column("width", Integer),
+                   Column("height", Integer),
+                   Column("fps", Float),
+                   Column("rotation", Integer, default=0),
+                   Column("timescale", Integer),
+                   Column("audio_codec", String(50)),
+                   Column("sample_rate", Integer),
+                   Column("channels", Integer),
+                   Column("frame_index", LargeBinary),
+                   Column("keyframe_index", LargeBinary)
+                   )
+
 tags = Table("singing_mistakes",
              metadata,
              Column("id", Integer, primary_key=True, autoincrement=True),
@@ -53,11 +74,25 @@ vocal_lesson_singing_mistakes = Table("vocal_lesson_singing_mistakes",
                                       Column("mistake_id", ForeignKey("singing_mistakes.id")))
 
 
+def _drop_stale_media_info():
+    # the index is rebuilt from the files on first use, a table from an older layout is dropped instead of migrated
+    existing = inspect(engine)
+    if existing.has_table(media_info.name):
+        columns = {column['name'] for column in existing.get_columns(media_info.name)}
+        if columns != set(media_info.columns.keys()):
+            media_info.drop(engine)
+
+
 def start_mappers():
+    _drop_stale_media_info()
     mapper_registry.metadata.create_all(engine)
     # tags_mapper = mapper_registry.map_imperatively(models.Tag, tags)
+    media_info_mapper = mapper_registry.map_imperatively(models.MediaInfo, media_info)
     files_mapper = mapper_registry.map_imperatively(models.File, files,
                                                     # properties={"tags": relationship(tags_mapper)}
+                                                    properties={"media_info": relationship(
+                                                        media_info_mapper, uselist=False,
+                                                        cascade="all, delete-orphan")}
                                                     )
     mapper_registry.map_imperatively(
         models.User,
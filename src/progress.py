@@ -0,0 +1,40 @@
+import time
+
+from result_store import ResultStore
+
+# Task functions report progress with report_progress(), the worker binds the task id in every
+# task process. Writes are throttled, so reporting from tight loops stays cheap.
+MIN_INTERVAL = 0.5
+
+_store = ResultStore()
+_task_id: str | None = None
+_stage: str | None = None
+_stage_started_at = 0.0
+_last_write_at = 0.0
+
+
+def bind(task_id: str | None):
+    global _task_id, _stage, _last_write_at
+    _task_id, _stage, _last_write_at = task_id, None, 0.0
+
+
+def report_progress(stage: str, fraction: float | None = None, eta: float | None = None):
+    global _stage, _stage_started_at, _last_write_at
+    if _task_id is None:
+        return
+
+    now = time.monotonic()
+    if stage != _stage:
+        _stage, _stage_started_at = stage, now
+    elif now - _last_write_at < MIN_INTERVAL and fraction != 1:
+        return
+    _last_write_at = now
+
+    if eta is None and fraction:
+        elapsed = now - _stage_started_at
+        eta = elapsed * (1 - fraction) / fraction
+    _store.set_progress(_task_id, {
+        'stage': stage,
+        'fraction': round(fraction, 4) if fraction is not None else None,
+        'eta': round(eta, 1) if eta is not None else None,
+    })
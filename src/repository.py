@@ -31,6 +31,9 @@ class Repository:
                 .filter(models.User.username == username)
                 .first())
 
+    def get_file_by_id(self, id: int) -> models.File | None:
+        return self.session.get(models.File, id)
+
     def get_file_by_uuid(self, id: uuid.UUID) -> models.File | None:
         return (self.session.query(models.File)
                 .filter(models.File.uuid == id)
@@ -60,6 +63,9 @@ class Repository:
     def commit(self):
         self.session.commit()
 
+    def rollback(self):
+        self.session.rollback()
+
     def get_user_available_files(self, username: str) -> list[dict]:
         user = self.get(username)
         files = user.files
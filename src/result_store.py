@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from conf.config import BASE_DIR, settings
+
+path_db = BASE_DIR / 'db/results.db'
+
+# Size based eviction sums the whole table, so it runs once per this many writes
+EVICT_EVERY = 100
+
+STATUS_QUEUED = 'queued'
+STATUS_PROCESSING = 'processing'
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+STATUS_TIMED_OUT = 'timed_out'
+
+FINISHED_STATUSES = {STATUS_OK, STATUS_FAILED, STATUS_CANCELLED, STATUS_TIMED_OUT}
+# a stopped task keeps its status, late writes of the worker or the task process are ignored
+STOPPED_STATUSES = (STATUS_CANCELLED, STATUS_TIMED_OUT)
+
+
+class ResultStore:
+    def __init__(self, path=path_db,
+                 ttl: int = settings.RESULTS_TTL,
+                 max_size: int = settings.RESULTS_MAX_SIZE):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads or forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                                    task_id TEXT PRIMARY KEY,
+                                    owner TEXT,
+                                    fingerprint TEXT,
+                                    status TEXT NOT NULL,
+                                    result TEXT,
+                                    error TEXT,
+                                    progress TEXT,
+                                    size INTEGER NOT NULL,
+                                    updated_at REAL NOT NULL,
+                                    expires_at REAL NOT NULL,
+                                    revision INTEGER NOT NULL)''')
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(results)')}
+            if 'error' not in columns:
+                # tables created before errors got their own column
+                connection.execute('ALTER TABLE results ADD COLUMN error TEXT')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_expires_at ON results (expires_at)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_updated_at ON results (updated_at)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_revision ON results (revision)')
+            connection.execute('CREATE INDEX IF NOT EXISTS results_fingerprint ON results (fingerprint)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, task_id: str) -> dict | None:
+        row = self.connection.execute(
+            'SELECT status, result, error, progress FROM results WHERE task_id = ? AND expires_at > ?',
+            (task_id, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        status, result, error, progress = row
+        return {'status': status,
+                'result': json.loads(result) if result is not None else None,
+                'error': error,
+                'progress': json.loads(progress) if progress is not None else None}
+
+    def get_result(self, task_id: str):
+        record = self.get(task_id)
+        if record:
+            return record['result']
+
+    def find_by_fingerprint(self, fingerprint: str) -> str | None:
+        # only a queued or running task stands in for an identical one; a finished result may name an output
+        # that was deleted since, repeated work is answered by the render and download caches instead
+        row = self.connection.execute(
+            'SELECT task_id FROM results WHERE fingerprint = ? AND expires_at > ? AND status IN (?, ?) '
+            'ORDER BY updated_at DESC LIMIT 1',
+            (fingerprint, time.time(), STATUS_QUEUED, STATUS_PROCESSING)
+        ).fetchone()
+        if row:
+            return row[0]
+
+    def save(self, task_id: str, result, status: str = STATUS_OK, owner=None, fingerprint: str | None = None,
+             error: str | None = None):
+        data = json.dumps(result) if result is not None else None
+        now = time.time()
+        # every write gets the next revision, so listeners can follow the table as a change feed
+        self.connection.execute(
+            'INSERT INTO results (task_id, owner, fingerprint, status, result, error, size, updated_at, expires_at,'
+            '  revision) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(revision), 0) + 1 FROM results)) '
+            'ON CONFLICT (task_id) DO UPDATE SET '
+            '  owner = COALESCE(excluded.owner, owner), fingerprint = COALESCE(excluded.fingerprint, fingerprint),'
+            '  status = excluded.status, result = excluded.result, error = excluded.error,'
+            '  progress = CASE WHEN excluded.status = ? THEN progress END,'
+            '  size = excluded.size, updated_at = excluded.updated_at,'
+            '  expires_at = excluded.expires_at, revision = excluded.revision '
+            'WHERE status NOT IN (?, ?)',
+            (task_id, str(owner) if owner is not None else None, fingerprint, status, data, error,
+             len(data or '') + len(error or ''), now, now + self.ttl, STATUS_PROCESSING, *STOPPED_STATUSES)
+        )
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def set_status(self, task_id: str, status: str, owner=None, fingerprint: str | None = None):
+        self.save(task_id, None, status=status, owner=owner, fingerprint=fingerprint)
+
+    def set_progress(self, task_id: str, progress: dict):
+        self.connection.execute(
+            'UPDATE results SET progress = ?, updated_at = ?,'
+            '  revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM results) '
+            'WHERE task_id = ? AND status NOT IN (?, ?)',
+            (json.dumps(progress), time.time(), task_id, *STOPPED_STATUSES)
+        )
+
+    def cancel(self, task_id: str, owner=None) -> bool:
+        query = ('UPDATE results SET status = ?, progress = NULL, updated_at = ?,'
+                 '  revision = (SELECT COALESCE(MAX(revision), 0) + 1 FROM results) '
+                 'WHERE task_id = ? AND status IN (?, ?)')
+        params = [STATUS_CANCELLED, time.time(), task_id, STATUS_QUEUED, STATUS_PROCESSING]
+        if owner is not None:
+            query += ' AND owner = ?'
+            params.append(str(owner))
+        return self.connection.execute(query, params).rowcount > 0
+
+    def last_revision(self) -> int:
+        return self.connection.execute('SELECT COALESCE(MAX(revision), 0) FROM results').fetchone()[0]
+
+    def changes(self, since_revision: int) -> list[dict]:
+        rows = self.connection.execute(
+            'SELECT revision, task_id, owner, status, progress FROM results WHERE revision > ? ORDER BY revision',
+            (since_revision,)
+        ).fetchall()
+        return [{'revision': revision, 'task_id': task_id, 'owner': owner, 'status': status,
+                 'progress': json.loads(progress) if progress is not None else None}
+                for revision, task_id, owner, status, progress in rows]
+
+    def evict(self):
+        # queued and running tasks are kept, their rows hold the owner and the fingerprint until they finish
+        finished = tuple(FINISHED_STATUSES)
+        placeholders = ', '.join('?' * len(finished))
+        self.connection.execute(f'DELETE FROM results WHERE expires_at <= ? AND status IN ({placeholders})',
+                                (time.time(), *finished))
+        self.connection.execute(
+            'DELETE FROM results WHERE task_id IN ('
+            '  SELECT task_id FROM ('
+            '    SELECT task_id, SUM(size) OVER (ORDER BY updated_at DESC) AS total FROM results'
+            f'   WHERE status IN ({placeholders})'
+            '  ) WHERE total > ?'
+            ')',
+            (*finished, self.max_size)
+        )
@@ -0,0 +1,54 @@
+from collections import defaultdict
+from enum import IntEnum
+
+from worker_pool import task_slot
+
+
+class TaskPriority(IntEnum):
+    interactive = 0
+    normal = 1
+    batch = 2
+
+
+def task_partition(task: dict) -> tuple[str, int, str | None]:
+    owner = task.get('owner')
+    return (task_slot(task),
+            int(task.get('priority', TaskPriority.normal)),
+            str(owner) if owner is not None else None)
+
+
+class FairScheduler:
+    # Start-time fair queuing across owners. A higher priority class is always served first, inside
+    # a class the owner with the lowest tag goes next. Dispatching a task advances the owner's tag by
+    # the expected run time of its function divided by the owner's weight, and the estimate is
+    # corrected by the real run time when the task finishes. Owners that were idle start from the
+    # current virtual time, so they can not save up credit, and one owner with a long backlog
+    # only delays the others by about one task per slot.
+    def __init__(self, weights: dict[str, float] | None = None, default_weight: float = 1.0,
+                 smoothing: float = 0.2):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.smoothing = smoothing
+        self.virtual_time = 0.0
+        self._tags: dict[str | None, float] = defaultdict(float)
+        self._estimates: dict[str, float] = {}
+
+    def weight(self, owner: str | None) -> float:
+        return self.weights.get(owner, self.default_weight)
+
+    def rank(self, key: tuple, head: tuple) -> tuple:
+        _, priority, owner = key
+        return priority, max(self._tags[owner], self.virtual_time), head
+
+    def dispatched(self, key: tuple) -> float:
+        slot, _, owner = key
+        start = max(self._tags[owner], self.virtual_time)
+        self.virtual_time = start
+        estimate = self._estimates.get(slot, 1.0)
+        self._tags[owner] = start + estimate / self.weight(owner)
+        return estimate
+
+    def finished(self, key: tuple, estimate: float, run_time: float):
+        slot, _, owner = key
+        self._estimates[slot] = (1 - self.smoothing) * self._estimates.get(slot, run_time) + self.smoothing * run_time
+        self._tags[owner] += (run_time - estimate) / self.weight(owner)
@@ -18,3 +18,5 @@ class CutSchema(CamelCaseSchema):
 class VideoEditing(CamelCaseSchema):
     speed: float | None = None
     frames: list[CutSchema]
+    # also package the result for adaptive streaming (HLS)
+    hls: bool = False
@@ -0,0 +1,9 @@
+from pydantic import Field
+
+from schemas.actions_schema import CamelCaseSchema
+
+
+class UploadCreateSchema(CamelCaseSchema):
+    filename: str
+    size: int = Field(ge=0)
+    hls: bool = False
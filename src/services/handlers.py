@@ -1,20 +1,33 @@
 import dataclasses
+import hashlib
 import os
+import shutil
 import uuid
+from typing import AsyncIterator
 
+import anyio
 from fastapi import UploadFile
+from sqlalchemy.exc import IntegrityError
 
 from async_tasks import create_task
 from notes_extractor.app.singing_transcription import transcript_audio
 import models
 from conf.config import settings, BASE_DIR
 from repository import Repository
+from scheduler import TaskPriority
 from schemas.actions_schema import VideoEditing
-from utils.video import download_youtube_video, YouTubeDlOptions, extract_audio_from_video_file, edit_video
+from utils.media import probe_media
+from utils.previews import generate_previews, previews_dir
+from utils.streaming import hls_dir, package_hls
+from utils.downloads import download_youtube_video
+from utils.hashing import file_digest, forget_file_digest, store_file_digest
+from utils.uploads import complete_upload, open_chunk, record_chunk, valid_filename, write_chunk
+from utils.video import YouTubeDlOptions, extract_audio_from_video_file, edit_video, AudioFormat
 from utils.audio import transcribe_audio
 
 
 STORAGE_DIR = BASE_DIR / settings.STORAGE_NAME
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 @dataclasses.dataclass
@@ -22,13 +35,90 @@ class TagSchema:
     name: str
 
 
-def save_user_file(repo: Repository, username: str, file: UploadFile):
+async def write_upload(file: UploadFile, path: str) -> tuple[int, str]:
+    # copied in fixed size chunks through worker threads, memory use does not depend on the file size;
+    # the content digest is computed in the same pass, so coalescing and caches never read the file again
+    digest, size = hashlib.sha256(), 0
+    tmp_path = os.path.join(os.path.dirname(path), f'.{uuid.uuid4().hex}.upload')
+    try:
+        async with await anyio.open_file(tmp_path, 'wb') as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if settings.UPLOAD_MAX_SIZE and size > settings.UPLOAD_MAX_SIZE:
+                    raise models.FileError(f'File is larger than {settings.UPLOAD_MAX_SIZE} bytes')
+                await anyio.to_thread.run_sync(digest.update, chunk)
+                await f.write(chunk)
+        await anyio.to_thread.run_sync(_publish, tmp_path, path)
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(_remove_if_exists, tmp_path)
+        raise
+    await anyio.to_thread.run_sync(store_file_digest, path, digest.hexdigest())
+    return size, digest.hexdigest()
+
+
+def _publish(tmp_path: str, path: str):
+    # linking fails when the name is taken, a stored file is never replaced
+    try:
+        os.link(tmp_path, path)
+    except FileExistsError:
+        raise models.FileError('This file already exists')
+    os.remove(tmp_path)
+
+
+def _remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+async def save_user_file(repo: Repository, username: str, file: UploadFile, hls: bool = False):
     filename = file.filename
-    file_path = STORAGE_DIR / filename
-    with open(file_path, "wb") as f:
-        content = file.file.read()
-        f.write(content)
+    if not valid_filename(filename):
+        raise models.FileError(f'Invalid file name {filename!r}')
+    path = str(STORAGE_DIR / filename)
+    await write_upload(file, path)
+    try:
+        await anyio.to_thread.run_sync(_add_user_file, repo, username, filename, hls)
+    except models.FileError:
+        await anyio.to_thread.run_sync(_remove_if_exists, path)
+        raise
+    return filename
+
+
+async def receive_upload_chunk(stream: AsyncIterator[bytes], upload_id: str, username: str, offset: int,
+                               length: int | None):
+    # the body is written at its offset as it arrives; on a dropped connection the bytes written so far are
+    # still recorded, so the client resumes from where the data ends
+    fd, size = await anyio.to_thread.run_sync(open_chunk, upload_id, username, offset, length)
+    position, buffer = offset, bytearray()
+    try:
+        async for data in stream:
+            buffer += data
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await anyio.to_thread.run_sync(write_chunk, fd, position, bytes(buffer), size)
+                position, buffer = position + len(buffer), bytearray()
+        if buffer:
+            await anyio.to_thread.run_sync(write_chunk, fd, position, bytes(buffer), size)
+            position += len(buffer)
+    finally:
+        os.close(fd)
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(record_chunk, upload_id, offset, position)
+
+
+def complete_user_upload(repo: Repository, upload_id: str, username: str) -> str:
+    session, path = complete_upload(upload_id, username)
+    # chunks arrive in any order, the digest is computed once over the assembled file
+    file_digest(path)
+    try:
+        _add_user_file(repo, username, session['filename'], session['hls'])
+    except models.FileError:
+        _remove_if_exists(path)
+        raise
+    return session['filename']
 
+
+def _add_user_file(repo: Repository, username: str, filename: str, hls: bool):
     with repo:
         user = repo.get(username)
         file = models.File(name=filename)
@@ -36,8 +126,59 @@ def save_user_file(repo: Repository, username: str, file: UploadFile):
 
         repo.add(user)
         repo.commit()
+        create_task(index_user_file, kwargs={'file_id': file.id, 'previews': True, 'hls': hls}, owner=user.id,
+                    priority=TaskPriority.interactive)
 
-    return filename
+
+def get_media_info(repo: Repository, file: models.File) -> models.MediaInfo:
+    # files stored before the index existed are probed on first use
+    if file.media_info is None:
+        file.media_info = probe_media(file.path)
+        try:
+            repo.commit()
+        except IntegrityError:
+            # indexed by a concurrent task, its row is loaded instead
+            repo.rollback()
+    return file.media_info
+
+
+def index_user_file(file_id: int, previews: bool = False, hls: bool = False):
+    # previews and HLS packaging are queued once the index exists, so they never probe the file concurrently
+    repo = Repository()
+
+    with repo:
+        file = repo.get_file_by_id(file_id)
+        if not file:
+            return
+        get_media_info(repo, file)
+        if previews:
+            create_task(generate_user_file_previews, kwargs={'file_id': file.id}, owner=file.user_id)
+        if hls:
+            create_task(package_user_file_hls, kwargs={'file_id': file.id}, owner=file.user_id)
+
+
+def generate_user_file_previews(file_id: int):
+    repo = Repository()
+
+    with repo:
+        file = repo.get_file_by_id(file_id)
+        if not file:
+            return
+        media = get_media_info(repo, file)
+        if media.has_video:
+            generate_previews(file.path, media, file.id)
+
+
+def package_user_file_hls(file_id: int):
+    repo = Repository()
+
+    with repo:
+        file = repo.get_file_by_id(file_id)
+        if not file:
+            return
+        media = get_media_info(repo, file)
+        if media.has_video:
+            package_hls(file.path, media, file.id)
 
 
 def get_vocal_lesson_recommendation(repo: Repository, username: str):
@@ -57,12 +198,16 @@ def save_user_file_from_youtube(link: str, options: YouTubeDlOptions, username:
     filename = download_youtube_video(link, options)
 
     file = models.File(name=filename)
+    file.media_info = probe_media(file.path)
+    # hashed here, so coalescing requests for the new file find its digest instead of hashing it on the API loop
+    file_digest(file.path)
     try:
         with repo:
             user = repo.get(username)
             user.append_file(file)
             repo.add(user)
             repo.commit()
+            create_task(generate_user_file_previews, kwargs={'file_id': file.id}, owner=user.id)
 
         return filename
     except models.FileError:
@@ -71,7 +216,10 @@ def save_user_file_from_youtube(link: str, options: YouTubeDlOptions, username:
 
 def extract_user_audio_from_video_file(
     user_id: int,
-    file_uuid: uuid.UUID
+    file_uuid: uuid.UUID,
+    format_: AudioFormat = AudioFormat.wav,
+    sample_rate: int | None = None,
+    channels: int | None = None
 ):
     repo = Repository()
 
@@ -80,9 +228,12 @@ def extract_user_audio_from_video_file(
         if not file:
             return
 
-        extracted_audio_filename = extract_audio_from_video_file(file.path)
+        extracted_audio_filename = extract_audio_from_video_file(file.path, get_media_info(repo, file), format_,
+                                                                 sample_rate, channels)
 
         file_for_save = models.File(extracted_audio_filename, user_id=user_id)
+        file_for_save.media_info = probe_media(file_for_save.path)
+        file_digest(file_for_save.path)
         try:
             with repo:
                 repo.add_file(file_for_save)
@@ -105,13 +256,17 @@ def edit_user_video(
         if not file:
             return
 
-        edited_filename = edit_video(editing, file.path)
+        edited_filename = edit_video(editing, file.path, get_media_info(repo, file))
         file_for_save = models.File(edited_filename, user_id=user_id)
+        file_for_save.media_info = probe_media(file_for_save.path)
+        file_digest(file_for_save.path)
 
         try:
             with repo:
                 repo.add_file(file_for_save)
                 repo.commit()
+                if editing.hls and file_for_save.media_info.has_video:
+                    package_hls(file_for_save.path, file_for_save.media_info, file_for_save.id)
 
             return edited_filename
         except models.FileError:
@@ -129,7 +284,7 @@ def transcribe_text_from_audio_file(
         if not file:
             return
 
-        text_from_audio = transcribe_audio(file.path)
+        text_from_audio = transcribe_audio(file.path, get_media_info(repo, file))
         update_file_extracted_text_by_uuid(file_uuid, text_from_audio)
         return text_from_audio
 
@@ -139,6 +294,30 @@ def get_file_by_uuid(repo: Repository, id: uuid.UUID):
         return repo.get_file_by_uuid(id)
 
 
+def get_file_preview_path(repo: Repository, id: uuid.UUID, name: str) -> str | None:
+    with repo:
+        file = repo.get_file_by_uuid(id)
+        if not file:
+            return None
+        path = os.path.join(previews_dir(file.id), name)
+    return path if os.path.isfile(path) else None
+
+
+def get_file_hls_path(repo: Repository, id: uuid.UUID, name: str) -> str | None:
+    with repo:
+        file = repo.get_file_by_uuid(id)
+        if not file:
+            return None
+        path = os.path.join(hls_dir(file.id), name)
+    return path if os.path.isfile(path) else None
+
+
+def get_user_file_paths(repo: Repository, file_uuid: uuid.UUID, user_id: int) -> list[str]:
+    with repo:
+        file = repo.get_file_by_file_id_and_user_id(file_uuid, user_id)
+        return [file.path] if file else []
+
+
 def update_file_uuid_by_name(repo: Repository,
                              id: uuid.UUID,
                              name: str):
@@ -167,7 +346,10 @@ def delete_file(repo: Repository,
         if not os.path.exists(file_path):
             raise FileNotFoundError()
 
+        forget_file_digest(file_path)
         os.remove(file_path)
+        shutil.rmtree(previews_dir(file.id), ignore_errors=True)
+        shutil.rmtree(hls_dir(file.id), ignore_errors=True)
         repo.delete_file(file)
         repo.commit()
 
@@ -185,7 +367,10 @@ def transcript_audio_file(
 
     task_id = create_task(transcript_audio,
                           kwargs=dict(path_save=STORAGE_DIR,
-                                      path_audio=file_path))
+                                      path_audio=file_path),
+                          owner=user_id,
+                          coalesce=True,
+                          inputs=[file_path])
     return task_id
 
 
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from result_store import ResultStore, FINISHED_STATUSES
+
+POLL_INTERVAL = 0.2
+
+
+class TaskEvents:
+    # One watcher per API process follows the result store change feed and fans status
+    # changes out to the subscribed requests, instead of every client polling the store.
+    def __init__(self, store: ResultStore, poll_interval: float = POLL_INTERVAL):
+        self.store = store
+        self.poll_interval = poll_interval
+        self._subscribers: dict[asyncio.Queue, tuple[str | None, str | None, int]] = {}
+        self._revision = 0
+        self._watcher: asyncio.Task | None = None
+
+    @asynccontextmanager
+    async def subscribe(self, task_id: str | None = None, owner=None):
+        queue = asyncio.Queue()
+        # taken before the subscriber reads the current state, so no change can fall in between; a running
+        # watcher may be behind it, the changes it has not delivered yet are already part of that state
+        revision = self.store.last_revision()
+        self._subscribers[queue] = (task_id, str(owner) if owner is not None else None, revision)
+        if self._watcher is None or self._watcher.done():
+            self._revision = revision
+            self._watcher = asyncio.create_task(self._watch())
+        try:
+            yield queue
+        finally:
+            self._subscribers.pop(queue, None)
+
+    async def wait(self, task_id: str, timeout: float) -> dict | None:
+        deadline = time.monotonic() + timeout
+        async with self.subscribe(task_id=task_id) as queue:
+            record = self.store.get(task_id)
+            while not record or record['status'] not in FINISHED_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                record = self.store.get(task_id)
+        return record
+
+    async def _watch(self):
+        while self._subscribers:
+            await asyncio.sleep(self.poll_interval)
+            for event in self.store.changes(self._revision):
+                self._revision = event['revision']
+                for queue, (task_id, owner, since) in self._subscribers.items():
+                    if task_id not in (None, event['task_id']) or owner not in (None, event['owner']):
+                        continue
+                    if event['revision'] <= since:
+                        continue
+                    queue.put_nowait(event)
@@ -0,0 +1,37 @@
+import os
+import time
+
+from utils.disk_cache import DiskCache
+
+
+def _write(path, size: int):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+
+
+def test_fetch_does_not_touch_linked_files(tmp_path):
+    cache = DiskCache(tmp_path / 'cache', 1024, suffix='.mp4')
+    _write(tmp_path / 'first.mp4', 10)
+    os.utime(tmp_path / 'first.mp4', (1_000_000, 1_000_000))
+    cache.store('key', str(tmp_path / 'first.mp4'))
+
+    assert cache.fetch('key', str(tmp_path / 'second.mp4'))
+    assert os.stat(tmp_path / 'first.mp4').st_mtime == 1_000_000
+    assert os.stat(tmp_path / 'second.mp4').st_mtime == 1_000_000
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = DiskCache(tmp_path / 'cache', 25)
+    for key in ('a', 'b'):
+        _write(tmp_path / key, 10)
+        cache.store(key, str(tmp_path / key))
+        time.sleep(0.01)
+    assert cache.fetch('a', str(tmp_path / 'a-copy'))
+    time.sleep(0.01)
+
+    _write(tmp_path / 'c', 10)
+    cache.store('c', str(tmp_path / 'c'))
+
+    assert sorted(os.listdir(tmp_path / 'cache' / '.access')) == ['a', 'c']
+    assert not cache.fetch('b', str(tmp_path / 'b-copy'))
+    assert cache.fetch('a', str(tmp_path / 'a-copy-2'))
@@ -0,0 +1,118 @@
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yt_dlp as youtube_dl
+
+from utils import downloads
+from utils.disk_cache import DiskCache
+from utils.video import YouTubeDlOptions
+
+CONTENT = os.urandom(3 * 1024 * 1024)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    # serves CONTENT as /video.mp4 and answers single byte ranges with 206, like a video CDN
+    ranges: list[str | None] = []
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body: bool):
+        if self.path.split('?')[0] != '/video.mp4':
+            self.send_error(404)
+            return
+        range_header = self.headers.get('Range')
+        self.ranges.append(range_header)
+        start, end = 0, len(CONTENT) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', range_header or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(CONTENT)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if body:
+            try:
+                self.wfile.write(CONTENT[start:end + 1])
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.ranges = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}/video.mp4'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads, 'PARTIAL_DIR', tmp_path / 'partial')
+    monkeypatch.setattr(downloads, 'LOCKS_DIR', tmp_path / 'locks')
+    monkeypatch.setattr(downloads, 'download_cache', DiskCache(tmp_path / 'files', 1024 ** 3))
+    return tmp_path
+
+
+def _options(directory) -> YouTubeDlOptions:
+    return YouTubeDlOptions(format='best', outtmpl=os.path.join(directory, '%(title)s.%(ext)s'))
+
+
+def test_download_is_stored_under_the_video_name(server, storage):
+    filename = downloads.download_youtube_video(server, _options(storage / 'user'))
+
+    with open(storage / 'user' / filename, 'rb') as f:
+        assert f.read() == CONTENT
+    assert not os.listdir(storage / 'partial')
+
+
+def test_repeated_download_comes_from_the_cache(server, storage, monkeypatch):
+    calls = []
+    download = downloads._download
+
+    def counted(*args):
+        calls.append(args)
+        return download(*args)
+
+    monkeypatch.setattr(downloads, '_download', counted)
+    first = downloads.download_youtube_video(server, _options(storage / 'first'))
+    second = downloads.download_youtube_video(server, _options(storage / 'second'))
+
+    assert len(calls) == 1
+    with open(storage / 'first' / first, 'rb') as f1, open(storage / 'second' / second, 'rb') as f2:
+        assert f1.read() == f2.read() == CONTENT
+
+
+def test_interrupted_download_is_resumed_with_a_range_request(server, storage):
+    options = _options(storage / 'user')
+    with youtube_dl.YoutubeDL(options.dict(by_alias=True)) as ydl:
+        info = ydl.extract_info(server, download=False)
+    # what an earlier attempt left behind when its worker was stopped
+    received = len(CONTENT) // 3
+    os.makedirs(storage / 'partial')
+    with open(storage / 'partial' / f'{downloads._download_key(info, options)}.{info["ext"]}.part', 'wb') as f:
+        f.write(CONTENT[:received])
+    RangeHandler.ranges = []
+
+    filename = downloads.download_youtube_video(server, options)
+
+    assert f'bytes={received}-' in RangeHandler.ranges
+    with open(storage / 'user' / filename, 'rb') as f:
+        assert f.read() == CONTENT
@@ -0,0 +1,54 @@
+import hashlib
+import os
+
+import pytest
+
+from utils import hashing
+
+
+@pytest.fixture(autouse=True)
+def digests_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(hashing, 'DIGESTS_DIR', tmp_path / 'digests')
+    hashing._file_digest.cache_clear()
+    yield tmp_path / 'digests'
+    hashing._file_digest.cache_clear()
+
+
+def _stored(directory) -> list[str]:
+    return [name for name in os.listdir(directory) if not name.startswith('.')]
+
+
+def test_digest_is_persisted_and_forgotten(tmp_path, digests_dir):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(b'content' * 1000)
+
+    assert hashing.file_digest(path) == hashlib.sha256(b'content' * 1000).hexdigest()
+    assert len(_stored(digests_dir)) == 1
+
+    hashing.forget_file_digest(path)
+    assert _stored(digests_dir) == []
+
+
+def test_stored_digest_is_used_without_reading_the_file(tmp_path, digests_dir):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(b'content')
+    hashing.store_file_digest(path, 'precomputed')
+    assert hashing.file_digest(path) == 'precomputed'
+
+
+def test_prune_keeps_the_most_recently_used_digests(tmp_path, digests_dir):
+    paths = []
+    for i in range(5):
+        paths.append(tmp_path / f'{i}.mp4')
+        paths[-1].write_bytes(bytes([i]))
+        hashing.file_digest(paths[-1])
+    for i, name in enumerate(sorted(_stored(digests_dir), key=lambda name: os.stat(digests_dir / name).st_mtime)):
+        os.utime(digests_dir / name, (1000 + i, 1000 + i))
+    hashing._file_digest.cache_clear()
+    hashing.file_digest(paths[0])
+
+    hashing.prune_digests(max_entries=2)
+
+    kept = _stored(digests_dir)
+    assert len(kept) == 2
+    assert os.path.basename(hashing._digest_path(os.path.abspath(paths[0]), 1, os.stat(paths[0]).st_mtime_ns)) in kept
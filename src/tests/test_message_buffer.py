@@ -0,0 +1,108 @@
+import os
+import pickle
+from datetime import datetime, timedelta
+
+import pytest
+
+from message_buffer import BaseMessageBuffer
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / 'db.dat'
+
+
+def _drain(buffer: BaseMessageBuffer) -> list:
+    messages = []
+    while (message := buffer.get()) is not None:
+        messages.append(message['i'])
+    return messages
+
+
+def test_messages_are_returned_oldest_first(path):
+    buffer = BaseMessageBuffer(path)
+    now = datetime.now()
+    for i, offset in enumerate([3, 1, 2]):
+        buffer.put({'i': i}, updated_at=now + timedelta(seconds=offset))
+    assert len(buffer) == 3
+    assert _drain(buffer) == [1, 2, 0]
+    assert len(buffer) == 0
+
+
+def test_journal_is_replayed_after_restart_without_acked_messages(path):
+    buffer = BaseMessageBuffer(path)
+    for i in range(5):
+        buffer.put({'i': i})
+    assert buffer.get()['i'] == 0
+    assert buffer.get()['i'] == 1
+
+    restarted = BaseMessageBuffer(path)
+    assert len(restarted) == 3
+    assert _drain(restarted) == [2, 3, 4]
+
+
+def test_ack_by_one_instance_is_seen_by_another(path):
+    first, second = BaseMessageBuffer(path), BaseMessageBuffer(path)
+    for i in range(4):
+        first.put({'i': i})
+    assert len(second) == 4
+    assert first.get()['i'] == 0
+    assert second.get()['i'] == 1
+    assert first.get()['i'] == 2
+    assert _drain(second) == [3]
+
+
+def test_partitions_are_filtered_and_ranked(path):
+    buffer = BaseMessageBuffer(path, partition=lambda values: values['owner'])
+    for i, owner in enumerate(['a', 'a', 'b']):
+        buffer.put({'i': i, 'owner': owner})
+    assert buffer.get(accept=lambda key: key == 'b')['i'] == 2
+    assert buffer.get(accept=lambda key: key == 'b') is None
+    assert buffer.get(rank=lambda key, head: (key != 'a', head))['i'] == 0
+
+
+def test_compaction_drops_acked_records(path):
+    buffer = BaseMessageBuffer(path, compact_min_garbage=10 ** 9)
+    for i in range(20):
+        buffer.put({'i': i, 'payload': 'x' * 100})
+    for _ in range(15):
+        buffer.get()
+    size = os.path.getsize(path)
+
+    buffer.compact()
+
+    assert os.path.getsize(path) < size / 3
+    assert _drain(BaseMessageBuffer(path)) == [15, 16, 17, 18, 19]
+
+
+def test_compaction_by_another_instance_changes_the_generation(path):
+    consumer, compactor = BaseMessageBuffer(path), BaseMessageBuffer(path)
+    for i in range(30):
+        consumer.put({'i': i})
+    received = [consumer.get()['i']]
+    received += [compactor.get()['i'] for _ in range(20)]
+    compactor.compact()
+    # appended after compaction, the journal is read from the start again whatever its inode or size
+    compactor.put({'i': 30})
+    generation = consumer._generation
+
+    received += _drain(consumer)
+
+    assert consumer._generation == generation + 1
+    assert sorted(received) == list(range(31))
+    assert os.path.getsize(path) >= consumer._offset
+    assert _drain(BaseMessageBuffer(path)) == []
+
+
+def test_torn_tail_is_truncated_and_later_appends_are_read(path):
+    buffer = BaseMessageBuffer(path)
+    for i in range(3):
+        buffer.put({'i': i})
+    with open(path, 'ab') as f:
+        f.write(pickle.dumps({'op': 'put', 'id': 'torn', 'score': 0, 'values': {'i': -1}})[:-5])
+
+    assert buffer.get()['i'] == 0
+    buffer.put({'i': 3})
+
+    assert _drain(buffer) == [1, 2, 3]
+    assert _drain(BaseMessageBuffer(path)) == []
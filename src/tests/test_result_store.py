@@ -0,0 +1,111 @@
+import pytest
+
+from result_store import (ResultStore, STATUS_CANCELLED, STATUS_FAILED, STATUS_OK, STATUS_PROCESSING,
+                          STATUS_QUEUED, STATUS_TIMED_OUT)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultStore(tmp_path / 'results.db', ttl=60, max_size=1024 ** 2)
+
+
+def test_saved_result_is_read_back(store):
+    store.set_status('task', STATUS_QUEUED, owner=1)
+    assert store.get('task') == {'status': STATUS_QUEUED, 'result': None, 'error': None, 'progress': None}
+
+    store.save('task', {'file': 'video.mp4'})
+    assert store.get('task')['result'] == {'file': 'video.mp4'}
+    assert store.get_result('task') == {'file': 'video.mp4'}
+    assert store.get('missing') is None
+
+
+def test_failure_is_stored_as_error(store):
+    store.set_status('task', STATUS_PROCESSING)
+    store.save('task', None, status=STATUS_FAILED, error='ValueError: boom')
+    assert store.get('task') == {'status': STATUS_FAILED, 'result': None, 'error': 'ValueError: boom',
+                                 'progress': None}
+
+
+def test_progress_is_kept_while_processing_only(store):
+    store.set_status('task', STATUS_PROCESSING)
+    store.set_progress('task', {'stage': 'rendering', 'fraction': 0.5})
+    assert store.get('task')['progress'] == {'stage': 'rendering', 'fraction': 0.5}
+
+    store.save('task', 'done')
+    assert store.get('task')['progress'] is None
+
+
+def test_changes_return_the_latest_write_of_every_task_in_order(store):
+    start = store.last_revision()
+    store.set_status('a', STATUS_QUEUED, owner=1)
+    store.set_status('b', STATUS_QUEUED, owner=2)
+    store.set_status('a', STATUS_PROCESSING)
+    store.set_progress('a', {'stage': 'cutting'})
+
+    changes = store.changes(start)
+    assert [(change['task_id'], change['owner'], change['status']) for change in changes] == [
+        ('b', '2', STATUS_QUEUED), ('a', '1', STATUS_PROCESSING)]
+    assert changes[-1]['progress'] == {'stage': 'cutting'}
+    assert changes[-1]['revision'] == store.last_revision()
+
+    store.save('b', 'done')
+    assert [(change['task_id'], change['status']) for change in store.changes(changes[-1]['revision'])] == [
+        ('b', STATUS_OK)]
+
+
+def test_cancel_checks_the_owner_and_the_status(store):
+    store.set_status('task', STATUS_QUEUED, owner=1)
+    assert not store.cancel('task', owner=2)
+    assert store.cancel('task', owner=1)
+    assert store.get('task')['status'] == STATUS_CANCELLED
+    assert not store.cancel('task', owner=1)
+
+    store.set_status('done', STATUS_QUEUED, owner=1)
+    store.save('done', 'result')
+    assert not store.cancel('done')
+
+
+@pytest.mark.parametrize('status', [STATUS_CANCELLED, STATUS_TIMED_OUT])
+def test_stopped_tasks_ignore_late_writes(store, status):
+    store.set_status('task', STATUS_PROCESSING)
+    store.save('task', None, status=status, error='stopped')
+    store.set_progress('task', {'stage': 'rendering'})
+    store.save('task', 'late result')
+    assert store.get('task')['status'] == status
+    assert store.get('task')['result'] is None
+
+
+def test_expired_finished_results_are_evicted(tmp_path):
+    store = ResultStore(tmp_path / 'results.db', ttl=-1, max_size=1024 ** 2)
+    store.set_status('queued', STATUS_QUEUED, owner=1)
+    store.set_status('running', STATUS_PROCESSING, owner=1)
+    store.save('done', 'result')
+    store.evict()
+
+    rows = dict(store.connection.execute('SELECT task_id, status FROM results'))
+    assert rows == {'queued': STATUS_QUEUED, 'running': STATUS_PROCESSING}
+
+
+def test_size_eviction_keeps_unfinished_tasks_and_newest_results(tmp_path):
+    store = ResultStore(tmp_path / 'results.db', ttl=60, max_size=250)
+    store.set_status('queued', STATUS_QUEUED, owner=1, fingerprint='f')
+    for i in range(5):
+        store.save(f'done-{i}', 'x' * 98)
+    store.set_status('running', STATUS_PROCESSING, owner=1)
+    store.evict()
+
+    task_ids = {task_id for task_id, in store.connection.execute('SELECT task_id FROM results')}
+    assert task_ids == {'queued', 'running', 'done-3', 'done-4'}
+    assert store.cancel('queued', owner=1)
+
+
+def test_only_unfinished_tasks_are_found_by_fingerprint(store):
+    store.set_status('queued', STATUS_QUEUED, fingerprint='a')
+    store.set_status('running', STATUS_QUEUED, fingerprint='b')
+    store.set_status('running', STATUS_PROCESSING)
+    store.set_status('done', STATUS_QUEUED, fingerprint='c')
+    store.save('done', 'video.mp4')
+
+    assert store.find_by_fingerprint('a') == 'queued'
+    assert store.find_by_fingerprint('b') == 'running'
+    assert store.find_by_fingerprint('c') is None
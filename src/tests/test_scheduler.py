@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from message_buffer import BaseMessageBuffer
+from scheduler import FairScheduler, TaskPriority, task_partition
+
+
+def render():
+    pass
+
+
+def extract():
+    pass
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    return BaseMessageBuffer(tmp_path / 'db.dat', partition=task_partition)
+
+
+def _put(buffer: BaseMessageBuffer, func, owner, number: int, priority=TaskPriority.normal, at: datetime = None):
+    buffer.put({'id': f'{owner}-{number}', 'task': func, 'kwargs': {}, 'owner': owner, 'priority': int(priority)},
+               updated_at=at)
+
+
+def _run(buffer: BaseMessageBuffer, scheduler: FairScheduler, count: int, run_time: float = 1.0) -> list[str]:
+    # one slot, every task finishes before the next one is dispatched
+    order = []
+    for _ in range(count):
+        task = buffer.get(rank=scheduler.rank)
+        key = task_partition(task)
+        estimate = scheduler.dispatched(key)
+        scheduler.finished(key, estimate, run_time)
+        order.append(task['id'])
+    return order
+
+
+def test_burst_of_one_owner_does_not_starve_another(buffer):
+    start = datetime.now()
+    for i in range(20):
+        _put(buffer, render, 'burst', i, at=start + timedelta(seconds=i))
+    scheduler = FairScheduler()
+    order = _run(buffer, scheduler, 3)
+
+    # queued later than the whole burst, still served next after the task already dispatched
+    for i in range(3):
+        _put(buffer, render, 'other', i, at=start + timedelta(seconds=100 + i))
+    order += _run(buffer, scheduler, 6)
+
+    assert order[:3] == ['burst-0', 'burst-1', 'burst-2']
+    assert order[3:] == ['other-0', 'burst-3', 'other-1', 'burst-4', 'other-2', 'burst-5']
+
+
+def test_weights_share_dispatches_in_proportion(buffer):
+    start = datetime.now()
+    for owner in ('heavy', 'light'):
+        for i in range(20):
+            _put(buffer, render, owner, i, at=start + timedelta(seconds=i))
+    order = _run(buffer, FairScheduler(weights={'heavy': 3}), 16)
+
+    assert sum(task_id.startswith('heavy') for task_id in order) == 12
+
+
+def test_interactive_tasks_go_before_normal_ones(buffer):
+    start = datetime.now()
+    for i in range(5):
+        _put(buffer, render, 'owner', i, at=start + timedelta(seconds=i))
+    _put(buffer, extract, 'other', 0, priority=TaskPriority.batch, at=start)
+    _put(buffer, extract, 'owner', 100, priority=TaskPriority.interactive, at=start + timedelta(seconds=50))
+
+    order = _run(buffer, FairScheduler(), 7)
+
+    assert order[0] == 'owner-100'
+    assert order[1:6] == [f'owner-{i}' for i in range(5)]
+    assert order[6] == 'other-0'
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from result_store import ResultStore, STATUS_OK, STATUS_PROCESSING, STATUS_QUEUED
+from task_events import TaskEvents
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultStore(tmp_path / 'results.db')
+
+
+def _drain(queue: asyncio.Queue) -> list[tuple[str, str]]:
+    events = []
+    while not queue.empty():
+        event = queue.get_nowait()
+        events.append((event['task_id'], event['status']))
+    return events
+
+
+def test_subscribers_get_changes_of_their_tasks_and_owners(store):
+    events = TaskEvents(store, poll_interval=0.05)
+
+    async def run():
+        async with events.subscribe(task_id='a') as by_task, events.subscribe(owner=2) as by_owner:
+            store.set_status('a', STATUS_QUEUED, owner=1)
+            store.set_status('b', STATUS_QUEUED, owner=2)
+            await asyncio.sleep(0.2)
+            return _drain(by_task), _drain(by_owner)
+
+    assert asyncio.run(run()) == ([('a', STATUS_QUEUED)], [('b', STATUS_QUEUED)])
+
+
+def test_late_subscriber_does_not_get_changes_from_before_it_subscribed(store):
+    events = TaskEvents(store, poll_interval=0.3)
+    store.set_status('task', STATUS_QUEUED)
+
+    async def run():
+        async with events.subscribe(task_id='task') as first:
+            await asyncio.sleep(0.05)
+            store.set_status('task', STATUS_PROCESSING)
+            # the watcher is still asleep and has not seen the change, the new subscriber reads it as current state
+            async with events.subscribe(task_id='task') as second:
+                await asyncio.sleep(0.4)
+                store.save('task', 'done')
+                await asyncio.sleep(0.4)
+                return _drain(first), _drain(second)
+
+    first, second = asyncio.run(run())
+    assert first == [('task', STATUS_PROCESSING), ('task', STATUS_OK)]
+    assert second == [('task', STATUS_OK)]
+
+
+def test_wait_returns_the_finished_task(store):
+    events = TaskEvents(store, poll_interval=0.05)
+    store.set_status('task', STATUS_PROCESSING)
+
+    async def run():
+        async def finish():
+            await asyncio.sleep(0.1)
+            store.save('task', 'done')
+
+        finishing = asyncio.create_task(finish())
+        record = await events.wait('task', timeout=2)
+        await finishing
+        return record
+
+    assert asyncio.run(run())['result'] == 'done'
+    assert asyncio.run(events.wait('task', timeout=0.1))['status'] == STATUS_OK
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import models
+from utils import uploads
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture(autouse=True)
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, 'STORAGE_DIR', tmp_path)
+    monkeypatch.setattr(uploads, 'UPLOADS_DIR', tmp_path / '.uploads')
+    return tmp_path
+
+
+def _send(upload_id: str, start: int, end: int, username: str = 'user'):
+    fd, size = uploads.open_chunk(upload_id, username, start, end - start)
+    try:
+        uploads.write_chunk(fd, start, CONTENT[start:end], size)
+    finally:
+        os.close(fd)
+    uploads.record_chunk(upload_id, start, end)
+
+
+def test_received_ranges_are_merged():
+    upload_id = uploads.create_upload('user', 'video.mp4', len(CONTENT))
+    for start, end in [(4000, 6000), (0, 1000), (1000, 2000), (5000, 7000), (8000, 9000)]:
+        _send(upload_id, start, end)
+
+    assert uploads.received_ranges(upload_id) == [(0, 2000), (4000, 7000), (8000, 9000)]
+
+
+def test_chunks_in_any_order_are_assembled(storage):
+    upload_id = uploads.create_upload('user', 'video.mp4', len(CONTENT))
+    for start in reversed(range(0, len(CONTENT), 3000)):
+        _send(upload_id, start, min(start + 3000, len(CONTENT)))
+
+    session, path = uploads.complete_upload(upload_id, 'user')
+
+    assert session['filename'] == 'video.mp4'
+    assert path == str(storage / 'video.mp4')
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    with pytest.raises(uploads.UploadNotFound):
+        uploads.get_upload(upload_id, 'user')
+
+
+def test_incomplete_upload_is_not_completed(storage):
+    upload_id = uploads.create_upload('user', 'video.mp4', len(CONTENT))
+    _send(upload_id, 0, 1000)
+    _send(upload_id, 2000, len(CONTENT))
+
+    with pytest.raises(uploads.UploadIncomplete):
+        uploads.complete_upload(upload_id, 'user')
+    assert not os.path.exists(storage / 'video.mp4')
+
+
+def test_chunk_past_the_end_is_rejected():
+    upload_id = uploads.create_upload('user', 'video.mp4', 100)
+    with pytest.raises(uploads.UploadError):
+        uploads.open_chunk(upload_id, 'user', 50, 60)
+
+
+def test_sessions_are_private():
+    upload_id = uploads.create_upload('user', 'video.mp4', len(CONTENT))
+    with pytest.raises(uploads.UploadNotFound):
+        uploads.get_upload(upload_id, 'other')
+    with pytest.raises(uploads.UploadNotFound):
+        uploads.abort_upload(upload_id, 'other')
+
+
+@pytest.mark.parametrize('filename', ['../../escape.bin', 'nested/video.mp4', '/etc/passwd', '..', '.', ''])
+def test_names_outside_the_storage_are_rejected(filename):
+    with pytest.raises(uploads.UploadError):
+        uploads.create_upload('user', filename, 10)
+
+
+def test_stored_file_is_not_replaced(storage):
+    (storage / 'video.mp4').write_bytes(b'stored')
+    upload_id = uploads.create_upload('user', 'video.mp4', len(CONTENT))
+    _send(upload_id, 0, len(CONTENT))
+
+    with pytest.raises(models.FileError):
+        uploads.complete_upload(upload_id, 'user')
+    assert (storage / 'video.mp4').read_bytes() == b'stored'
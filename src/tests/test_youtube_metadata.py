@@ -0,0 +1,114 @@
+import asyncio
+import threading
+
+import pytest
+
+from youtube_metadata import YouTubeMetadata, video_id
+
+VIDEO_ID = 'dQw4w9WgXcQ'
+
+
+@pytest.mark.parametrize('link', [
+    VIDEO_ID,
+    f'https://www.youtube.com/watch?v={VIDEO_ID}',
+    f'https://youtube.com/watch?feature=share&v={VIDEO_ID}&t=42',
+    f'http://m.youtube.com/watch?v={VIDEO_ID}',
+    f'https://music.youtube.com/watch?v={VIDEO_ID}&list=RD{VIDEO_ID}',
+    f'youtube.com/watch?v={VIDEO_ID}',
+    f'https://youtu.be/{VIDEO_ID}',
+    f'https://youtu.be/{VIDEO_ID}?si=abc',
+    f'https://www.youtube.com/shorts/{VIDEO_ID}',
+    f'https://www.youtube.com/embed/{VIDEO_ID}',
+    f'https://www.youtube-nocookie.com/embed/{VIDEO_ID}',
+    f'https://www.youtube.com/live/{VIDEO_ID}?feature=share',
+    f'  https://youtu.be/{VIDEO_ID}  ',
+])
+def test_video_id_normalizes_links(link):
+    assert video_id(link) == VIDEO_ID
+
+
+@pytest.mark.parametrize('link', [
+    'https://example.com/watch?v=dQw4w9WgXcQ',
+    'https://www.youtube.com/watch?v=short',
+    'https://www.youtube.com/@channel',
+    'not a link',
+])
+def test_video_id_keeps_unknown_links(link):
+    assert video_id(link) == link.strip()
+
+
+class Extractor:
+    # stand-in for yt-dlp, blocks until released so concurrent lookups overlap
+    def __init__(self, error: Exception | None = None):
+        self.calls = []
+        self.error = error
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, link: str) -> dict:
+        self.calls.append(link)
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return {'id': video_id(link), 'formats': [{'format_id': '18'}, {'format_id': '22'}]}
+
+
+def test_concurrent_lookups_of_one_video_share_the_extraction():
+    extractor = Extractor()
+    extractor.release.clear()
+    metadata = YouTubeMetadata(extractor, ttl=60, max_workers=4)
+
+    async def run():
+        lookups = [asyncio.create_task(metadata.formats(link)) for link in
+                   (VIDEO_ID, f'https://youtu.be/{VIDEO_ID}', f'https://www.youtube.com/watch?v={VIDEO_ID}')]
+        await asyncio.sleep(0.1)
+        extractor.release.set()
+        return await asyncio.gather(*lookups)
+
+    results = asyncio.run(run())
+    assert len(extractor.calls) == 1
+    assert all(formats == [{'format_id': '18'}, {'format_id': '22'}] for formats in results)
+
+
+def test_results_are_cached_until_the_ttl_expires():
+    async def lookups(metadata: YouTubeMetadata):
+        await metadata.info(VIDEO_ID)
+        await metadata.info(f'https://youtu.be/{VIDEO_ID}')
+
+    extractor = Extractor()
+    asyncio.run(lookups(YouTubeMetadata(extractor, ttl=60)))
+    assert len(extractor.calls) == 1
+
+    extractor = Extractor()
+    asyncio.run(lookups(YouTubeMetadata(extractor, ttl=0)))
+    assert len(extractor.calls) == 2
+
+
+def test_failures_are_not_cached():
+    extractor = Extractor(error=ValueError('unavailable'))
+    metadata = YouTubeMetadata(extractor, ttl=60)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                await metadata.info(VIDEO_ID)
+
+    asyncio.run(run())
+    assert len(extractor.calls) == 2
+
+
+def test_cancelled_request_does_not_cancel_the_shared_lookup():
+    extractor = Extractor()
+    extractor.release.clear()
+    metadata = YouTubeMetadata(extractor, ttl=60)
+
+    async def run():
+        first = asyncio.create_task(metadata.info(VIDEO_ID))
+        second = asyncio.create_task(metadata.info(VIDEO_ID))
+        await asyncio.sleep(0.1)
+        first.cancel()
+        extractor.release.set()
+        return await second
+
+    assert asyncio.run(run())['id'] == VIDEO_ID
+    assert len(extractor.calls) == 1
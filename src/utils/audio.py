@@ -1,15 +1,34 @@
 import json
+import os
+import tempfile
 
 import speech_recognition as sr
+
+import models
+from progress import report_progress
+from utils.media import probe_media
+from utils.video import AudioFormat, extract_audio
+
 recognizer = sr.Recognizer()
 
 RECOGNIZE_CHUNK_DURATION = 1
+# the rate and layout vosk recognizes, anything else is converted sample by sample in Python before recognition
+SPEECH_SAMPLE_RATE = 16000
+SPEECH_CHANNELS = 1
+
 
+def transcribe_audio(path: str, media: models.MediaInfo | None = None) -> str:
+    media = media or probe_media(path)
+    with tempfile.TemporaryDirectory() as directory:
+        speech_path = os.path.join(directory, 'speech.wav')
+        extract_audio(path, speech_path, media, AudioFormat.wav, SPEECH_SAMPLE_RATE, SPEECH_CHANNELS)
 
-def transcribe_audio(path: str) -> str:
-    with sr.AudioFile(path) as source:
-        audio = recognizer.record(source)
+        report_progress("reading audio")
+        with sr.AudioFile(speech_path) as source:
+            audio = recognizer.record(source)
 
+    # vosk recognizes the whole recording in one call, so only the stage is known
+    report_progress("recognizing")
     text = recognizer.recognize_vosk(audio, language="ru")
 
     return json.loads(text)['text']
\ No newline at end of file
@@ -0,0 +1,86 @@
+import os
+import shutil
+import uuid
+
+
+def _link(source: str, destination: str):
+    # hard links keep a file readable by one render while another one evicts it from the cache
+    try:
+        os.link(source, destination)
+    except OSError as exc:
+        if isinstance(exc, FileNotFoundError):
+            raise
+        shutil.copyfile(source, destination)
+
+
+class DiskCache:
+    # Files stored under a key, least recently used ones are removed once the total size exceeds max_size.
+    # Several worker processes share the directory, all changes are atomic renames.
+    # Entries share their inode with the files linked from them, so uses are recorded by the mtime of an empty
+    # marker per key; touching the entry itself would change the mtime of user files made from it.
+    def __init__(self, directory, max_size: int, suffix: str = ''):
+        self.directory = str(directory)
+        self.access_directory = os.path.join(self.directory, '.access')
+        self.max_size = max_size
+        self.suffix = suffix
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}{self.suffix}')
+
+    def fetch(self, key: str, destination: str) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            _link(self.path(key), destination)
+        except FileNotFoundError:
+            return False
+        self._touch(key)
+        return True
+
+    def store(self, key: str, source: str):
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = os.path.join(self.directory, f'.{uuid.uuid4().hex}.tmp')
+        _link(source, tmp_path)
+        os.replace(tmp_path, self.path(key))
+        self._touch(key)
+        self.evict()
+
+    def _touch(self, key: str):
+        os.makedirs(self.access_directory, exist_ok=True)
+        with open(os.path.join(self.access_directory, key), 'a'):
+            pass
+        os.utime(os.path.join(self.access_directory, key))
+
+    def _last_access(self, key: str, stat: os.stat_result) -> float:
+        try:
+            return os.stat(os.path.join(self.access_directory, key)).st_mtime
+        except FileNotFoundError:
+            return stat.st_mtime
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix) and not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    key = entry.name[:len(entry.name) - len(self.suffix)]
+                    entries.append((self._last_access(key, stat), stat.st_size, key))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            for path in (self.path(key), os.path.join(self.access_directory, key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
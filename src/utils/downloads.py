@@ -0,0 +1,86 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import uuid
+
+import yt_dlp as youtube_dl
+
+from conf.config import STORAGE_DIR, settings
+from progress import report_progress
+from utils.disk_cache import DiskCache
+from utils.video import YouTubeDlOptions
+
+DOWNLOADS_DIR = STORAGE_DIR / '.cache' / 'downloads'
+# interrupted downloads stay here under their key and are continued with range requests by the next attempt
+PARTIAL_DIR = DOWNLOADS_DIR / 'partial'
+LOCKS_DIR = DOWNLOADS_DIR / 'locks'
+
+# finished downloads by video and format, shared by all users
+download_cache = DiskCache(DOWNLOADS_DIR / 'files', settings.YOUTUBE_DOWNLOAD_CACHE_SIZE)
+
+
+def _download_key(info: dict, options: YouTubeDlOptions) -> str:
+    return hashlib.sha256(repr((info.get('extractor_key'), info['id'], options.format)).encode()).hexdigest()
+
+
+def _rate_limit() -> int | None:
+    # the limit is shared by the downloads the worker runs at the same time
+    if not settings.YOUTUBE_DOWNLOAD_RATE_LIMIT:
+        return None
+    slots = settings.WORKER_CONCURRENCY.get('save_user_file_from_youtube', settings.WORKER_DEFAULT_CONCURRENCY)
+    return max(1, settings.YOUTUBE_DOWNLOAD_RATE_LIMIT // max(1, slots))
+
+
+@contextlib.contextmanager
+def _locked(key: str):
+    # one process downloads a video, the others asking for it wait here and take it from the cache afterwards
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    with open(os.path.join(LOCKS_DIR, f'{key}.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _report_download(status: dict):
+    total = status.get('total_bytes') or status.get('total_bytes_estimate')
+    if status.get('status') == 'downloading' and total:
+        report_progress('downloading', min(status.get('downloaded_bytes', 0) / total, 1.0), status.get('eta'))
+
+
+def _place(source: str, destination: str):
+    # linked next to the destination and renamed over it, readers never see a partial file
+    tmp_path = os.path.join(os.path.dirname(destination), f'.{uuid.uuid4().hex}.tmp')
+    os.link(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def _download(info: dict, key: str, options: YouTubeDlOptions) -> str:
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    params = options.dict(by_alias=True)
+    params.update({'outtmpl': os.path.join(PARTIAL_DIR, f'{key}.%(ext)s'), 'continuedl': True,
+                   'ratelimit': _rate_limit(), 'progress_hooks': [_report_download]})
+    with youtube_dl.YoutubeDL(params) as ydl:
+        result = ydl.process_ie_result(info, download=True)
+    return result['requested_downloads'][0]['filepath']
+
+
+def download_youtube_video(link: str, options: YouTubeDlOptions) -> str:
+    with youtube_dl.YoutubeDL(options.dict(by_alias=True)) as ydl:
+        info = ydl.extract_info(link, download=False)
+        destination = ydl.prepare_filename(info)
+    key = _download_key(info, options)
+
+    with _locked(key):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        cached_path = os.path.join(os.path.dirname(destination), f'.{uuid.uuid4().hex}.download')
+        if download_cache.fetch(key, cached_path):
+            os.replace(cached_path, destination)
+        else:
+            path = _download(info, key, options)
+            _place(path, destination)
+            download_cache.store(key, path)
+            os.remove(path)
+    return os.path.basename(destination)
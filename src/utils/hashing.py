@@ -0,0 +1,102 @@
+import functools
+import hashlib
+import os
+import time
+import uuid
+
+from conf.config import STORAGE_DIR, settings
+
+CHUNK_SIZE = 1024 * 1024
+
+# digests outlive the process that computed them, worker tasks run in fresh processes
+DIGESTS_DIR = STORAGE_DIR / '.cache' / 'digests'
+# the store is trimmed to DIGESTS_MAX_ENTRIES at most once per interval, the marker's mtime is the last run
+PRUNE_MARKER = '.pruned'
+PRUNE_INTERVAL = 60 * 60
+
+
+def file_digest(path) -> str:
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def store_file_digest(path, digest: str):
+    # for callers that hashed the content while writing it
+    stat = os.stat(path)
+    _store_digest(_digest_path(os.path.abspath(path), stat.st_size, stat.st_mtime_ns), digest)
+
+
+def forget_file_digest(path):
+    # for deleted files, their digest would never be looked up again
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return
+    try:
+        os.remove(_digest_path(os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    except FileNotFoundError:
+        pass
+
+
+def prune_digests(max_entries: int = settings.DIGESTS_MAX_ENTRIES):
+    # digests of rewritten or removed files are left behind, the least recently used entries go first
+    os.makedirs(DIGESTS_DIR, exist_ok=True)
+    open(os.path.join(DIGESTS_DIR, PRUNE_MARKER), 'a').close()
+    os.utime(os.path.join(DIGESTS_DIR, PRUNE_MARKER))
+    entries = []
+    with os.scandir(DIGESTS_DIR) as it:
+        for entry in it:
+            if not entry.name.startswith('.'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+    for _, path in sorted(entries)[:max(0, len(entries) - max_entries)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _maybe_prune():
+    try:
+        pruned_at = os.stat(os.path.join(DIGESTS_DIR, PRUNE_MARKER)).st_mtime
+    except FileNotFoundError:
+        pruned_at = 0
+    if time.time() - pruned_at >= PRUNE_INTERVAL:
+        prune_digests()
+
+
+def _digest_path(path: str, size: int, mtime_ns: int) -> str:
+    name = hashlib.sha256(f'{path}:{size}:{mtime_ns}'.encode()).hexdigest()
+    return os.path.join(DIGESTS_DIR, name)
+
+
+def _store_digest(digest_path: str, digest: str):
+    os.makedirs(DIGESTS_DIR, exist_ok=True)
+    tmp_path = os.path.join(DIGESTS_DIR, f'.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(digest)
+    os.replace(tmp_path, digest_path)
+    _maybe_prune()
+
+
+# size and mtime are part of the key, so a rewritten file is hashed again
+@functools.lru_cache(maxsize=4096)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    digest_path = _digest_path(path, size, mtime_ns)
+    try:
+        with open(digest_path) as f:
+            digest = f.read()
+        # the mtime of a stored digest is its last use
+        os.utime(digest_path)
+        return digest
+    except FileNotFoundError:
+        pass
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    _store_digest(digest_path, digest.hexdigest())
+    return digest.hexdigest()
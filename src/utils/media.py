@@ -0,0 +1,84 @@
+import re
+import subprocess
+
+from moviepy.config import get_setting
+
+import models
+
+FFMPEG_BINARY = get_setting('FFMPEG_BINARY')
+
+CHANNEL_LAYOUTS = {'mono': 1, 'stereo': 2, 'quad': 4}
+
+
+class MediaError(Exception):
+    pass
+
+
+def _channels(layout: str) -> int | None:
+    # ffmpeg prints either a layout name ("stereo", "5.1(side)") or "N channels"
+    if layout in CHANNEL_LAYOUTS:
+        return CHANNEL_LAYOUTS[layout]
+    if match := re.match(r'(\d+)\.(\d+)', layout):
+        return int(match.group(1)) + int(match.group(2))
+    if match := re.match(r'(\d+) channels', layout):
+        return int(match.group(1))
+    return None
+
+
+def probe_media(path: str) -> models.MediaInfo:
+    # one ffmpeg run prints the container and stream headers to stderr and, without decoding anything,
+    # every packet of the first video stream to stdout
+    command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-i', path,
+               '-map', '0:v:0?', '-c', 'copy', '-f', 'framecrc', '-']
+    process = subprocess.run(command, capture_output=True, text=True)
+    header = process.stderr
+
+    container = re.search(r'Input #0, (.+?), from', header)
+    if not container:
+        lines = header.strip().splitlines()
+        raise MediaError(lines[-1] if lines else f'Can not read {path}')
+    duration = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', header)
+    info = models.MediaInfo(
+        duration=int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+        if duration else 0.0,
+        format_name=container.group(1))
+
+    video = re.search(r'Stream #0:\d+.*?: Video: (\w+)[^,]*, (\w+).*?, (\d+)x(\d+)(.*)', header)
+    if video:
+        if process.returncode:
+            lines = header.strip().splitlines()
+            raise MediaError(lines[-1] if lines else f'ffmpeg exited with code {process.returncode}')
+        fps = re.search(r'(\d+(?:\.\d+)?) (?:fps|tbr)', video.group(5))
+        info.video_codec, info.pix_fmt = video.group(1), video.group(2)
+        info.width, info.height = int(video.group(3)), int(video.group(4))
+        info.fps = float(fps.group(1)) if fps else None
+        # the stream metadata and side data follow on the lines up to the next stream
+        rotate = re.search(r'^\s+rotate\s*:\s*(-?\d+)', header[video.end():].split('Stream #')[0], re.MULTILINE)
+        info.rotation = int(rotate.group(1)) % 360 if rotate else 0
+        _index_packets(info, process.stdout)
+
+    audio = re.search(r'Stream #0:\d+.*?: Audio: (\w+).*?, (\d+) Hz, ([^,\n]+)', header)
+    if audio:
+        info.audio_codec = audio.group(1)
+        info.sample_rate = int(audio.group(2))
+        info.channels = _channels(audio.group(3).strip())
+    return info
+
+
+def _index_packets(info: models.MediaInfo, framecrc: str):
+    # keyframes are the packets without the F= flags column
+    ticks, keyframe_ticks = [], []
+    for line in framecrc.splitlines():
+        if line.startswith('#tb 0:'):
+            numerator, denominator = line.split(':', 1)[1].strip().split('/')
+            if numerator != '1':
+                raise MediaError(f'Unsupported time base {numerator}/{denominator}')
+            info.timescale = int(denominator)
+        elif line and not line.startswith('#'):
+            fields = [field.strip() for field in line.split(',')]
+            flags = int(fields[6][2:], 16) if len(fields) > 6 else 1
+            ticks.append(int(fields[2]))
+            if flags & 1:
+                keyframe_ticks.append(int(fields[2]))
+    info.frame_index = models.pack_times(sorted(ticks))
+    info.keyframe_index = models.pack_times(sorted(keyframe_ticks))
@@ -0,0 +1,85 @@
+import math
+import os
+import shutil
+import tempfile
+
+import models
+from conf.config import STORAGE_DIR
+from utils.render import run_ffmpeg
+
+PREVIEWS_DIR = STORAGE_DIR / 'previews'
+
+PROXY_NAME = 'proxy.mp4'
+PROXY_HEIGHT = 360
+PROXY_CRF = 30
+# a keyframe every second keeps seeking in the proxy cheap
+PROXY_KEYFRAME_INTERVAL = 1
+
+THUMBNAILS_NAME = 'thumbnails.vtt'
+THUMBNAIL_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+MAX_THUMBNAILS = 400
+
+
+def previews_dir(file_id: int) -> str:
+    return str(PREVIEWS_DIR / str(file_id))
+
+
+def _even(value: float) -> int:
+    return max(2, int(round(value / 2)) * 2)
+
+
+def _timestamp(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}'
+
+
+def generate_previews(path: str, media: models.MediaInfo, file_id: int):
+    # everything is written to a temporary directory next to the final one and swapped in at the end
+    directory = previews_dir(file_id)
+    os.makedirs(PREVIEWS_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f'.{file_id}-', dir=PREVIEWS_DIR)
+    try:
+        proxy_path = os.path.join(work_dir, PROXY_NAME)
+        _make_proxy(path, media, proxy_path)
+        _make_thumbnails(proxy_path, media, work_dir)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(work_dir, directory)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+
+def _make_proxy(path: str, media: models.MediaInfo, proxy_path: str):
+    fps = media.fps or 30
+    args = ['-i', path, '-map', '0:v:0', '-vf', f'scale=-2:{min(PROXY_HEIGHT, _even(media.display_height))}',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(PROXY_CRF), '-pix_fmt', 'yuv420p',
+            '-g', str(round(fps * PROXY_KEYFRAME_INTERVAL))]
+    if media.has_audio:
+        args += ['-map', '0:a:0', '-c:a', 'aac', '-b:a', '64k', '-ac', '1']
+    run_ffmpeg([*args, '-movflags', '+faststart', proxy_path], media.duration, 'generating proxy')
+
+
+def _make_thumbnails(proxy_path: str, media: models.MediaInfo, work_dir: str):
+    # thumbnails are taken from the proxy keyframes only, nothing else has to be decoded
+    interval = max(PROXY_KEYFRAME_INTERVAL, math.ceil(media.duration / MAX_THUMBNAILS))
+    width = THUMBNAIL_WIDTH
+    height = _even(width * media.display_height / media.display_width)
+    run_ffmpeg(['-skip_frame', 'nokey', '-i', proxy_path, '-map', '0:v:0',
+                '-vf', f'fps=1/{interval},scale={width}:{height},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}',
+                '-vsync', 'vfr', '-q:v', '5', os.path.join(work_dir, 'sprite_%03d.jpg')],
+               media.duration, 'generating thumbnails')
+
+    per_sprite = SPRITE_COLUMNS * SPRITE_ROWS
+    lines = ['WEBVTT', '']
+    for i in range(math.ceil(media.duration / interval)):
+        start, end = i * interval, min((i + 1) * interval, media.duration)
+        sprite, position = divmod(i, per_sprite)
+        row, column = divmod(position, SPRITE_COLUMNS)
+        lines += [f'{_timestamp(start)} --> {_timestamp(end)}',
+                  f'sprite_{sprite + 1:03d}.jpg#xywh={column * width},{row * height},{width},{height}', '']
+    with open(os.path.join(work_dir, THUMBNAILS_NAME), 'w') as f:
+        f.write('\n'.join(lines))
@@ -0,0 +1,348 @@
+import bisect
+import dataclasses
+import hashlib
+import json
+import logging
+import math
+import os
+import subprocess
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import models
+from conf.config import settings, STORAGE_DIR
+from progress import report_progress
+from schemas.actions_schema import VideoEditing
+from utils.disk_cache import DiskCache
+from utils.hashing import file_digest
+from utils.media import FFMPEG_BINARY, probe_media
+
+logger = logging.getLogger(__name__)
+
+VIDEO_CODEC = 'libx264'
+VIDEO_PRESET = 'medium'
+AUDIO_CODEC = 'aac'
+
+# atempo accepts factors in this range, larger speed changes are chained
+ATEMPO_MIN = 0.5
+ATEMPO_MAX = 2.0
+
+# codecs whose parts can be re-encoded with VIDEO_CODEC and joined with stream copied parts
+STREAM_COPY_CODECS = {'h264'}
+
+# bumped whenever the output of the same edit changes, so earlier renders are not returned from the cache
+RENDER_VERSION = 2
+
+# encoded parts are kept between renders, so repeated and unchanged segments are encoded once
+part_cache = DiskCache(STORAGE_DIR / '.cache' / 'parts', settings.RENDER_PARTS_CACHE_SIZE, suffix='.mp4')
+# whole outputs by source content and edit, a resubmitted edit is linked instead of rendered
+render_cache = DiskCache(STORAGE_DIR / '.cache' / 'renders', settings.RENDER_CACHE_SIZE, suffix='.mp4')
+
+
+class RenderError(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Segment:
+    # source interval in seconds and the playback speed it is rendered with
+    start: float
+    end: float
+    speed: float = 1.0
+
+    @property
+    def duration(self) -> float:
+        return (self.end - self.start) / self.speed
+
+
+@dataclasses.dataclass(frozen=True)
+class Part:
+    # a piece of the output video written to its own file, either stream copied from a keyframe or re-encoded;
+    # frames is the number of output frames, so parts join without gaps
+    start: float
+    end: float
+    frames: int
+    speed: float = 1.0
+    copy: bool = False
+
+
+def _tolerance(media: models.MediaInfo) -> float:
+    # half a frame, positions closer than that to a frame are taken as that frame
+    return 0.5 / (media.fps or 30)
+
+
+def _count_frames(media: models.MediaInfo, start: float, end: float) -> int:
+    return bisect.bisect_left(media.frame_times, end) - bisect.bisect_left(media.frame_times, start)
+
+
+def _speed(value: float | None) -> float:
+    if value is None or value == 0:
+        return 1.0
+    if value < 0:
+        raise RenderError(f'Speed must be positive, got {value}')
+    return value
+
+
+def plan_segments(editing: VideoEditing, duration: float) -> list[Segment]:
+    # the global speed is folded into every segment, so the whole edit is a plain concatenation
+    speed = _speed(editing.speed)
+    segments = []
+    for frame in editing.frames:
+        start, end = max(frame.cut_from, 0), min(frame.cut_to, duration)
+        if end <= start:
+            raise RenderError(f'Cut {frame.cut_from}-{frame.cut_to} is empty or outside of the video')
+        segments.extend([Segment(start, end, _speed(frame.speed) * speed)] * frame.times)
+
+    if not segments and editing.speed:
+        segments.append(Segment(0, duration, speed))
+    return segments
+
+
+def _atempo(speed: float) -> list[str]:
+    factors = []
+    while speed > ATEMPO_MAX:
+        factors.append(ATEMPO_MAX)
+        speed /= ATEMPO_MAX
+    while speed < ATEMPO_MIN:
+        factors.append(ATEMPO_MIN)
+        speed /= ATEMPO_MIN
+    factors.append(speed)
+    return [f'atempo={factor:.6g}' for factor in factors]
+
+
+def build_filter_graph(segments: list[Segment], has_audio: bool, has_video: bool = True, first_input: int = 0) -> str:
+    # input first_input + i holds segment i (trimmed by input seeking), every segment is retimed and then concatenated
+    chains, concat_inputs = [], []
+    for i, segment in enumerate(segments, start=first_input):
+        if has_video:
+            chains.append(f'[{i}:v:0]setpts=(PTS-STARTPTS)/{segment.speed:.6g}[v{i}]')
+            concat_inputs.append(f'[v{i}]')
+        if has_audio:
+            audio_filters = ['asetpts=PTS-STARTPTS']
+            if segment.speed != 1:
+                audio_filters.extend(_atempo(segment.speed))
+            chains.append(f'[{i}:a:0]{",".join(audio_filters)}[a{i}]')
+            concat_inputs.append(f'[a{i}]')
+
+    outputs = ('[outv]' if has_video else '') + ('[outa]' if has_audio else '')
+    chains.append(f'{"".join(concat_inputs)}concat=n={len(segments)}:v={int(has_video)}:a={int(has_audio)}{outputs}')
+    return ';'.join(chains)
+
+
+def _segment_inputs(segments: list[Segment], path: str) -> list[str]:
+    args = []
+    for segment in segments:
+        args += ['-ss', f'{segment.start:.3f}', '-t', f'{segment.end - segment.start:.3f}', '-i', path]
+    return args
+
+
+def plan_parts(segment: Segment, media: models.MediaInfo, tolerance: float) -> list[Part]:
+    # smart cut: the keyframe aligned middle of the segment is copied as is,
+    # only the frames before its first keyframe and after its last one are re-encoded
+    keyframes = media.keyframe_times
+    first = bisect.bisect_left(keyframes, segment.start - tolerance)
+    last = bisect.bisect_right(keyframes, segment.end + tolerance) - 1
+    reaches_end = segment.end + tolerance >= media.frame_times[-1]
+    if first >= len(keyframes) or keyframes[first] >= segment.end:
+        frames = _count_frames(media, segment.start - tolerance, segment.end - tolerance)
+        return [Part(segment.start, segment.end, frames)]
+
+    copy_start = keyframes[first]
+    copy_end = segment.end if reaches_end else keyframes[last]
+    boundaries = [(segment.start, copy_start, False), (copy_start, copy_end, True), (copy_end, segment.end, False)]
+    parts = []
+    for start, end, copy in boundaries:
+        frames = _count_frames(media, start - tolerance, end - tolerance)
+        if frames:
+            parts.append(Part(start, end, frames, copy=copy))
+    return parts
+
+
+def plan_chunks(segment: Segment, media: models.MediaInfo, tolerance: float, chunk_duration: float) -> list[Part]:
+    # chunks start on source keyframes, so every encoder seeks straight to its first frame;
+    # the keyframes are the first ones of every chunk_duration slot of the source rather than counted from the segment
+    # start, so segments that cover the same stretch of the source share its chunks and an edited cut only changes
+    # the chunks at its edges; retimed chunks keep the source frame rate, so their frame count scales with the speed
+    keyframes = media.keyframe_times
+    bounds = [segment.start]
+    slot = math.floor(segment.start / chunk_duration) + 1
+    for keyframe in keyframes[bisect.bisect_right(keyframes, segment.start):bisect.bisect_left(keyframes, segment.end)]:
+        if keyframe >= slot * chunk_duration and segment.end - keyframe >= chunk_duration / 2:
+            bounds.append(keyframe)
+            slot = math.floor(keyframe / chunk_duration) + 1
+    bounds.append(segment.end)
+    return [Part(start, end, round(_count_frames(media, start - tolerance, end - tolerance) / segment.speed),
+                 segment.speed)
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def _render_parallelism() -> int:
+    return settings.RENDER_PARALLELISM or os.cpu_count() or 1
+
+
+def _can_stream_copy(segments: list[Segment], media: models.MediaInfo) -> bool:
+    return media.video_codec in STREAM_COPY_CODECS and bool(media.keyframe_times) and all(
+        segment.speed == 1 for segment in segments)
+
+
+def _source_id(path: str) -> str:
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def _part_key(source_id: str, part: Part, pix_fmt: str, rotation: int) -> str:
+    return hashlib.sha256(repr((source_id, part, VIDEO_CODEC, VIDEO_PRESET, pix_fmt, rotation)).encode()).hexdigest()
+
+
+def render_key(segments: list[Segment], path: str) -> str:
+    # edits are compared by their planned segments, so specs that only differ in form (a missing speed, cuts past
+    # the end, camel or snake case fields) share one entry
+    data = {
+        'source': file_digest(path),
+        'segments': [dataclasses.astuple(segment) for segment in segments],
+        'profile': [VIDEO_CODEC, VIDEO_PRESET, AUDIO_CODEC, RENDER_VERSION],
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def _render_parts(segments: list[Segment], path: str, media: models.MediaInfo, output_path: str,
+                  plans: dict[Segment, list[Part]], pix_fmt: str, stage: str):
+    # video parts are written to MP4 files in the source timescale and joined by the concat demuxer, which
+    # converts H.264 to Annex B with the parameter sets of every part inline; audio is cheap to encode and is
+    # rendered from the source in the final pass, so it stays continuous across the parts.
+    # Every distinct part is written once and referenced as many times as it is used.
+    work_dir = tempfile.mkdtemp(prefix='.render-', dir=os.path.dirname(output_path))
+    try:
+        source_id = _source_id(path)
+        parts = list(dict.fromkeys(part for segment in segments for part in plans[segment]))
+        part_paths = {part: os.path.join(work_dir, f'{i}.mp4') for i, part in enumerate(parts)}
+        missing = [part for part in parts
+                   if not part_cache.fetch(_part_key(source_id, part, pix_fmt, media.rotation), part_paths[part])]
+        logger.info('Rendering %s: %d of %d parts cached', path, len(parts) - len(missing), len(parts))
+        if missing:
+            _write_parts(missing, part_paths, path, media, pix_fmt, stage)
+        for part in missing:
+            part_cache.store(_part_key(source_id, part, pix_fmt, media.rotation), part_paths[part])
+
+        playlist_path = os.path.join(work_dir, 'parts.txt')
+        with open(playlist_path, 'w') as f:
+            f.writelines(f"file '{part_paths[part]}'\n" for segment in segments for part in plans[segment])
+
+        args = ['-f', 'concat', '-safe', '0', '-i', playlist_path]
+        if media.has_audio:
+            args += _segment_inputs(segments, path)
+            args += ['-filter_complex', build_filter_graph(segments, True, has_video=False, first_input=1),
+                     '-map', '[outa]', '-c:a', AUDIO_CODEC]
+        args += ['-map', '0:v:0', '-c:v', 'copy', '-movflags', '+faststart', output_path]
+        run_ffmpeg(args, sum(segment.duration for segment in segments), 'joining')
+    finally:
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+
+def _write_parts(parts: list[Part], part_paths: dict[Part, str], path: str, media: models.MediaInfo,
+                 pix_fmt: str, stage: str):
+    # every part is a separate ffmpeg process, threads only wait for them; the cores are split between
+    # the encoders that run at the same time
+    workers = min(_render_parallelism(), len(parts))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    total = sum(part.end - part.start for part in parts)
+    done = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_write_part, part, path, media, pix_fmt, threads, part_paths[part]): part
+                   for part in parts}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                done += futures[future].end - futures[future].start
+                report_progress(stage, done / total)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _write_part(part: Part, path: str, media: models.MediaInfo, pix_fmt: str, threads: int, part_path: str):
+    tolerance = _tolerance(media)
+    # encoded parts keep the coded orientation and the rotation of the source, like the copied ones next to them
+    if part.copy:
+        # a copied input starts at the keyframe at or before the position, so the position must not round below it;
+        # seeking past the keyframe would keep it with a negative timestamp and the MP4 muxer would hide it
+        args = ['-ss', f'{math.ceil(part.start * 1_000_000) / 1_000_000:.6f}', '-noautorotate', '-i', path,
+                '-map', '0:v:0', '-c:v', 'copy']
+    else:
+        args = ['-ss', f'{part.start - tolerance:.6f}', '-noautorotate', '-i', path, '-map', '0:v:0']
+        if part.speed != 1:
+            args += ['-vf', f'setpts=(PTS-STARTPTS)/{part.speed:.6g}', '-r', f'{media.fps or 30:g}']
+        args += ['-c:v', VIDEO_CODEC, '-preset', VIDEO_PRESET, '-pix_fmt', pix_fmt, '-threads', str(threads)]
+    args += ['-frames:v', str(part.frames)]
+    if media.timescale:
+        args += ['-video_track_timescale', str(media.timescale)]
+    run_ffmpeg([*args, '-an', part_path])
+
+
+def run_ffmpeg(args: list[str], duration: float | None = None, stage: str | None = None):
+    # ffmpeg writes key=value progress blocks to stdout, out_time_ms is in microseconds despite the name
+    command = [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error', '-nostats',
+               '-progress', 'pipe:1', '-y', *args]
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        for line in process.stdout:
+            key, _, value = line.strip().partition('=')
+            if stage and duration and key == 'out_time_ms' and value.isdigit():
+                report_progress(stage, min(int(value) / 1_000_000 / duration, 1.0))
+        if process.wait():
+            stderr.seek(0)
+            lines = stderr.read().strip().splitlines()
+            raise RenderError(lines[-1] if lines else f'ffmpeg exited with code {process.returncode}')
+
+
+def render(editing: VideoEditing, path: str, media: models.MediaInfo | None = None) -> str | None:
+    media = media or probe_media(path)
+    segments = plan_segments(editing, media.duration)
+    if not segments:
+        return None
+
+    stem, _ = os.path.splitext(path)
+    output_path = f'{stem}_{uuid.uuid4()}_modified_merged.mp4'
+    key = render_key(segments, path) if render_cache.enabled else None
+    if key and render_cache.fetch(key, output_path):
+        return os.path.basename(output_path)
+    try:
+        _render(segments, path, media, output_path)
+    except BaseException:
+        # failed, cancelled or timed out renders must not leave a partial file in the storage
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    if key:
+        render_cache.store(key, output_path)
+    return os.path.basename(output_path)
+
+
+def _render(segments: list[Segment], path: str, media: models.MediaInfo, output_path: str):
+    if _can_stream_copy(segments, media):
+        plans = {segment: plan_parts(segment, media, _tolerance(media)) for segment in segments}
+        try:
+            _render_parts(segments, path, media, output_path, plans, media.pix_fmt, 'cutting')
+            return
+        except RenderError as exc:
+            logger.warning('Stream copy of %s failed, re-encoding: %s', path, exc)
+
+    if media.has_video and media.keyframe_times:
+        # chunked even for a single encoder, unchanged chunks of an edited spec come from the part cache
+        plans = {segment: plan_chunks(segment, media, _tolerance(media), settings.RENDER_CHUNK_DURATION)
+                 for segment in segments}
+        _render_parts(segments, path, media, output_path, plans, 'yuv420p', 'rendering')
+        return
+
+    args = _segment_inputs(segments, path)
+    args += ['-filter_complex', build_filter_graph(segments, media.has_audio, media.has_video)]
+    if media.has_video:
+        args += ['-map', '[outv]', '-c:v', VIDEO_CODEC, '-preset', VIDEO_PRESET, '-pix_fmt', 'yuv420p']
+    if media.has_audio:
+        args += ['-map', '[outa]', '-c:a', AUDIO_CODEC]
+    run_ffmpeg([*args, '-movflags', '+faststart', output_path],
+               sum(segment.duration for segment in segments), 'rendering')
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+
+import models
+from conf.config import STORAGE_DIR, settings
+from utils.render import AUDIO_CODEC, VIDEO_CODEC, run_ffmpeg
+
+HLS_DIR = STORAGE_DIR / 'hls'
+MASTER_PLAYLIST = 'master.m3u8'
+HLS_NAME_PATTERN = r'^(master\.m3u8|v\d+/(index\.m3u8|init(_\d+)?\.mp4|segment_\d{5}\.m4s))$'
+HLS_MEDIA_TYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.m4s': 'video/iso.segment', '.mp4': 'video/mp4'}
+
+HLS_PRESET = 'veryfast'
+HLS_AUDIO_BITRATE = '128k'
+# sources that players can decode as they are get an untouched top rendition
+COPY_CODECS = {'h264'}
+COPY_PIX_FMTS = {'yuv420p'}
+
+
+def hls_dir(file_id: int) -> str:
+    return str(HLS_DIR / str(file_id))
+
+
+def _renditions(media: models.MediaInfo) -> list[tuple[int, int]]:
+    # (height, video kbps) from the lowest, rungs above the source are encoded at the source height once
+    renditions = {}
+    for height, bitrate in sorted(settings.HLS_RENDITIONS.items()):
+        renditions.setdefault(min(height, media.display_height), bitrate)
+    return sorted(renditions.items())
+
+
+def _segment_starts(keyframe_times: list[float], segment_duration: float) -> list[float]:
+    # the same rule the hls muxer cuts by: the first keyframe once the output reaches the next multiple of hls_time
+    starts, number = [], 1
+    for time in keyframe_times:
+        if time > 0 and time >= number * segment_duration:
+            starts.append(time)
+            number += 1
+    return starts
+
+
+def package_hls(path: str, media: models.MediaInfo, file_id: int):
+    # every rendition is cut at the same times, so players switch between them at any segment boundary
+    directory = hls_dir(file_id)
+    os.makedirs(HLS_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f'.{file_id}-', dir=HLS_DIR)
+    try:
+        run_ffmpeg([*_hls_args(path, media, work_dir), os.path.join(work_dir, 'v%v', 'index.m3u8')],
+                   media.duration, 'packaging')
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(work_dir, directory)
+    except BaseException:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+
+def _hls_args(path: str, media: models.MediaInfo, work_dir: str) -> list[str]:
+    segment_duration = settings.HLS_SEGMENT_DURATION
+    # encoded renditions are auto-rotated, a rotated source is encoded too so all of them are shown the same way
+    # and the playlist resolutions are the displayed ones
+    copy = media.video_codec in COPY_CODECS and media.pix_fmt in COPY_PIX_FMTS and bool(media.keyframe_times) \
+        and media.rotation == 0
+    renditions = _renditions(media)
+    if copy:
+        renditions = [rendition for rendition in renditions if rendition[0] < media.height]
+        # encoded renditions get keyframes exactly where the copied one is cut; the encoder rounds forced times
+        # to its 1/fps time base, so the margin has to stay well below half a frame
+        margin = 0.25 / (media.fps or 30)
+        key_frames = [max(0.0, time - margin) for time in _segment_starts(media.keyframe_times, segment_duration)]
+    else:
+        key_frames = [time * segment_duration for time in range(1, int(media.duration // segment_duration) + 1)]
+
+    outputs = [f'[v{i}]' for i in range(len(renditions))]
+    args = ['-i', path]
+    if renditions:
+        scales = ';'.join(f'[s{i}]scale=-2:{height}{output}'
+                          for i, ((height, _), output) in enumerate(zip(renditions, outputs)))
+        splits = ''.join(f'[s{i}]' for i in range(len(renditions)))
+        args += ['-filter_complex', f'[0:v:0]split={len(renditions)}{splits};{scales}']
+
+    video_maps = (['0:v:0'] if copy else []) + outputs
+    streams = []
+    for i, video_map in enumerate(video_maps):
+        args += ['-map', video_map]
+        streams.append(f'v:{i}')
+        if media.has_audio:
+            args += ['-map', '0:a:0']
+            streams[-1] += f',a:{i}'
+
+    offset = 0
+    if copy:
+        args += ['-c:v:0', 'copy']
+        offset = 1
+    for i, (_, bitrate) in enumerate(renditions, offset):
+        args += [f'-c:v:{i}', VIDEO_CODEC, f'-b:v:{i}', f'{bitrate}k', f'-maxrate:v:{i}', f'{bitrate * 3 // 2}k',
+                 f'-bufsize:v:{i}', f'{bitrate * 2}k']
+    if renditions:
+        # no keyframes but the forced ones, otherwise the muxer could cut the renditions at different frames
+        args += ['-preset', HLS_PRESET, '-pix_fmt', 'yuv420p', '-x264-params', 'scenecut=0:keyint=infinite',
+                 '-force_key_frames', ','.join(f'{time:.6f}' for time in [0.0, *key_frames])]
+    if media.has_audio:
+        if media.audio_codec == AUDIO_CODEC:
+            args += ['-c:a', 'copy']
+        else:
+            args += ['-c:a', AUDIO_CODEC, '-b:a', HLS_AUDIO_BITRATE]
+
+    return [*args, '-f', 'hls', '-hls_time', str(segment_duration), '-hls_playlist_type', 'vod',
+            '-hls_segment_type', 'fmp4', '-hls_flags', 'independent_segments',
+            '-hls_fmp4_init_filename', 'init.mp4', '-master_pl_name', MASTER_PLAYLIST,
+            '-hls_segment_filename', os.path.join(work_dir, 'v%v', 'segment_%05d.m4s'),
+            '-var_stream_map', ' '.join(streams)]
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+import models
+from conf.config import STORAGE_DIR, settings
+
+# every upload session is a directory with its metadata, the preallocated data file and one marker per received
+# chunk; markers are created after their chunk is written, so parallel requests need no lock
+UPLOADS_DIR = STORAGE_DIR / '.uploads'
+SESSION_NAME = 'session.json'
+DATA_NAME = 'data'
+RANGES_NAME = 'ranges'
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadNotFound(UploadError):
+    pass
+
+
+class UploadIncomplete(UploadError):
+    pass
+
+
+def valid_filename(filename: str) -> bool:
+    # the name becomes a path in the storage, it must not point anywhere else
+    return bool(filename) and os.path.basename(filename) == filename and filename not in (os.curdir, os.pardir)
+
+
+def _session_dir(upload_id: str) -> str:
+    return os.path.join(UPLOADS_DIR, str(uuid.UUID(upload_id)))
+
+
+def create_upload(username: str, filename: str, size: int, hls: bool = False) -> str:
+    if settings.UPLOAD_MAX_SIZE and size > settings.UPLOAD_MAX_SIZE:
+        raise UploadError(f'File is larger than {settings.UPLOAD_MAX_SIZE} bytes')
+    if not valid_filename(filename):
+        raise UploadError(f'Invalid file name {filename!r}')
+    remove_expired_uploads()
+    upload_id = str(uuid.uuid4())
+    directory = _session_dir(upload_id)
+    os.makedirs(os.path.join(directory, RANGES_NAME))
+    with open(os.path.join(directory, DATA_NAME), 'wb') as f:
+        f.truncate(size)
+    with open(os.path.join(directory, SESSION_NAME), 'w') as f:
+        json.dump({'username': username, 'filename': filename, 'size': size, 'hls': hls}, f)
+    return upload_id
+
+
+def get_upload(upload_id: str, username: str) -> dict:
+    try:
+        with open(os.path.join(_session_dir(upload_id), SESSION_NAME)) as f:
+            session = json.load(f)
+    except (ValueError, FileNotFoundError):
+        raise UploadNotFound(f'Upload {upload_id} is not exists')
+    if session['username'] != username:
+        raise UploadNotFound(f'Upload {upload_id} is not exists')
+    return session
+
+
+def open_chunk(upload_id: str, username: str, offset: int, length: int | None) -> tuple[int, int]:
+    # returns the descriptor of the data file and the upload size
+    session = get_upload(upload_id, username)
+    if offset < 0 or offset > session['size'] or (length is not None and offset + length > session['size']):
+        raise UploadError(f'Chunk at {offset} does not fit into {session["size"]} bytes')
+    return os.open(os.path.join(_session_dir(upload_id), DATA_NAME), os.O_WRONLY), session['size']
+
+
+def write_chunk(fd: int, offset: int, data: bytes, size: int):
+    if offset + len(data) > size:
+        raise UploadError(f'Chunk at {offset} does not fit into {size} bytes')
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data, offset = data[written:], offset + written
+
+
+def record_chunk(upload_id: str, start: int, end: int):
+    if end > start:
+        open(os.path.join(_session_dir(upload_id), RANGES_NAME, f'{start}-{end}'), 'w').close()
+
+
+def received_ranges(upload_id: str) -> list[tuple[int, int]]:
+    ranges = []
+    for name in os.listdir(os.path.join(_session_dir(upload_id), RANGES_NAME)):
+        start, end = name.split('-')
+        ranges.append((int(start), int(end)))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def complete_upload(upload_id: str, username: str) -> tuple[dict, str]:
+    # the assembled file is moved into the storage, it is registered by the caller
+    session = get_upload(upload_id, username)
+    if session['size'] and received_ranges(upload_id) != [(0, session['size'])]:
+        raise UploadIncomplete(f'Upload {upload_id} is missing data')
+    path = str(STORAGE_DIR / session['filename'])
+    try:
+        # linking fails when the name is taken, a stored file is never replaced
+        os.link(os.path.join(_session_dir(upload_id), DATA_NAME), path)
+    except FileNotFoundError:
+        # completed by a concurrent request
+        raise UploadNotFound(f'Upload {upload_id} is not exists')
+    except FileExistsError:
+        raise models.FileError('This file already exists')
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+    return session, path
+
+
+def abort_upload(upload_id: str, username: str):
+    get_upload(upload_id, username)
+    shutil.rmtree(_session_dir(upload_id), ignore_errors=True)
+
+
+def remove_expired_uploads():
+    # sessions without a new chunk for UPLOAD_SESSION_TTL seconds are dropped
+    if not os.path.isdir(UPLOADS_DIR):
+        return
+    expired_at = time.time() - settings.UPLOAD_SESSION_TTL
+    with os.scandir(UPLOADS_DIR) as it:
+        for entry in it:
+            ranges_path = os.path.join(entry.path, RANGES_NAME)
+            try:
+                last_activity = max(entry.stat().st_mtime, os.stat(ranges_path).st_mtime)
+            except FileNotFoundError:
+                continue
+            if last_activity < expired_at:
+                shutil.rmtree(entry.path, ignore_errors=True)
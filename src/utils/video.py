@@ -1,15 +1,14 @@
 import os
-import uuid
-import moviepy.video.fx.all as vfx
-from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.video.compositing.concatenate import concatenate_videoclips
-from moviepy.video.io.VideoFileClip import VideoFileClip
-from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
+from enum import Enum
+
 import yt_dlp as youtube_dl
 from pydantic import BaseModel, Field
 
+import models
 from conf.config import settings
 from schemas.actions_schema import VideoEditing
+from utils.media import MediaError, probe_media
+from utils.render import render, run_ffmpeg
 
 
 class YouTubeDlOptions(BaseModel):
@@ -21,78 +20,84 @@ class YouTubeDlOptions(BaseModel):
     list_formats: bool = Field(default=False, alias='listformats')  # print a list of the formats to stdout and exit
 
 
-def _cut_video_file(path: str, start_time: int, end_time: int, new_file_name: str):
-    cropped_video_path = path.replace(".mp4", f"_{new_file_name}.mp4")
-    ffmpeg_extract_subclip(path, start_time, end_time, targetname=cropped_video_path)
-    return cropped_video_path
-
-
-def _merge_video_files(paths: list[str]):
-    loaded_video_list = []
-    merged_video_name = f"{paths[0].split('_')[0]}_modified_merged.mp4"
-    for path in paths:
-        loaded_video_list.append(VideoFileClip(path))
-
-    final_clip = concatenate_videoclips(loaded_video_list)
-
-    final_clip.write_videofile(merged_video_name)
-    return merged_video_name.split('\\')[-1]
-
-
-def _apply_video_speed_effect(path: str, speed: float):
-    video = VideoFileClip(path)
-    speed_modified_video_name = f"{path.split('.')[0]}_modified.mp4"
-    final_clip = video.fx(vfx.speedx, speed)
-    final_clip.write_videofile(speed_modified_video_name)
-    return speed_modified_video_name.split('\\')[-1]
-
-
-def edit_video(editing: VideoEditing, path: str) -> str | None:
-    frame_paths = []
-    edited_video_path = None
-    for frame in editing.frames:
-        frame_id = str(uuid.uuid4())
-        frame_path = _cut_video_file(path, frame.cut_from, frame.cut_to, frame_id)
-        if frame.speed:
-            frame_path = _apply_video_speed_effect(path, frame.speed)
-        frame_paths.extend([frame_path] * frame.times)
-
-    if frame_paths:
-        edited_video_path = _merge_video_files(frame_paths)
-
-    if editing.speed:
-        edited_video_path = _apply_video_speed_effect(path, editing.speed)
-
-    # # remove used frames
-    for path in set(frame_paths):
-        os.remove(path)
-
-    return edited_video_path
-
-
-def extract_audio_from_video_file(path: str) -> str:
-    audio_clip = AudioFileClip(path)
-    path = path.replace(".mp4", "_audio.wav")
-    audio_clip.write_audiofile(path)
-    file_name = path.split("\\")[-1]
-    return file_name
+class AudioFormat(str, Enum):
+    original = 'original'
+    wav = 'wav'
+    flac = 'flac'
+    mp3 = 'mp3'
+    m4a = 'm4a'
+    ogg = 'ogg'
+    opus = 'opus'
+
+
+# format: (codec as ffmpeg reports it, encoder)
+AUDIO_CODECS = {
+    AudioFormat.wav: ('pcm_s16le', 'pcm_s16le'),
+    AudioFormat.flac: ('flac', 'flac'),
+    AudioFormat.mp3: ('mp3', 'libmp3lame'),
+    AudioFormat.m4a: ('aac', 'aac'),
+    AudioFormat.ogg: ('vorbis', 'libvorbis'),
+    AudioFormat.opus: ('opus', 'libopus'),
+}
+# source codecs without a format of their own are copied into Matroska audio
+COPY_FALLBACK_EXTENSION = 'mka'
+
+
+def edit_video(editing: VideoEditing, path: str, media: models.MediaInfo | None = None) -> str | None:
+    return render(editing, path, media)
+
+
+def _source_format(media: models.MediaInfo) -> AudioFormat | None:
+    for audio_format, (codec, _) in AUDIO_CODECS.items():
+        if codec == media.audio_codec:
+            return audio_format
+    return None
+
+
+def _audio_extension(media: models.MediaInfo, format_: AudioFormat) -> str:
+    if format_ is AudioFormat.original:
+        format_ = _source_format(media)
+    return format_.value if format_ else COPY_FALLBACK_EXTENSION
+
+
+def extract_audio(path: str, output_path: str, media: models.MediaInfo, format_: AudioFormat = AudioFormat.wav,
+                  sample_rate: int | None = None, channels: int | None = None):
+    # the audio stream is copied when the format holds the source codec and nothing has to be resampled,
+    # otherwise ffmpeg decodes and encodes it in one pass straight to the requested rate and channels
+    if not media.has_audio:
+        raise MediaError(f'{os.path.basename(path)} has no audio')
+    if format_ is AudioFormat.original:
+        format_ = _source_format(media) or format_
+    codec, encoder = AUDIO_CODECS.get(format_, (media.audio_codec, 'pcm_s16le'))
+    args = ['-i', path, '-map', '0:a:0']
+    if codec == media.audio_codec and sample_rate in (None, media.sample_rate) and channels in (None, media.channels):
+        args += ['-c:a', 'copy']
+    else:
+        args += ['-c:a', encoder]
+        if sample_rate:
+            args += ['-ar', str(sample_rate)]
+        if channels:
+            args += ['-ac', str(channels)]
+    run_ffmpeg([*args, output_path], media.duration, "extracting audio")
+
+
+def extract_audio_from_video_file(path: str, media: models.MediaInfo | None = None,
+                                  format_: AudioFormat = AudioFormat.wav, sample_rate: int | None = None,
+                                  channels: int | None = None) -> str:
+    media = media or probe_media(path)
+    stem, _ = os.path.splitext(path)
+    suffix = (f'_{sample_rate}hz' if sample_rate else '') + (f'_{channels}ch' if channels else '')
+    audio_path = f'{stem}_audio{suffix}.{_audio_extension(media, format_)}'
+    try:
+        extract_audio(path, audio_path, media, format_, sample_rate, channels)
+    except BaseException:
+        if os.path.exists(audio_path):
+            os.remove(audio_path)
+        raise
+    return os.path.basename(audio_path)
 
 
 def get_youtube_video_info(link: str, options: YouTubeDlOptions, download: bool = False):
     with youtube_dl.YoutubeDL(options.dict(by_alias=True)) as ydl:
         data = ydl.extract_info(link, download=download)
     return data
-
-
-def get_youtube_video_formats(link: str):
-    data = get_youtube_video_info(link=link, options=YouTubeDlOptions())
-    return data.get('formats', [data])
-
-
-def download_youtube_video(link: str, options: YouTubeDlOptions):
-    data = get_youtube_video_info(link=link, options=options, download=True)
-    file_name = data.get("requested_downloads", [])[0].get("filename")
-    path_win = file_name.split('\\')
-    path = file_name.split('/')
-    path: list[str] = path if len(path) > 1 else path_win
-    return path[-1]
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from collections import defaultdict
+from multiprocessing.connection import Connection
+
+import progress
+
+logger = logging.getLogger(__name__)
+
+# Time a stopped task gets to run its cleanup after SIGTERM before it is killed
+KILL_GRACE_PERIOD = 10
+
+
+class TaskFailed(Exception):
+    pass
+
+
+class TaskCancelled(TaskFailed):
+    pass
+
+
+class TaskTimedOut(TaskFailed):
+    pass
+
+
+class TaskInterrupted(BaseException):
+    # raised inside a task process on SIGTERM, so finally blocks and context managers can clean up
+    pass
+
+
+def task_slot(task: dict) -> str:
+    return task['task'].__name__
+
+
+def _interrupt(signum, frame):
+    raise TaskInterrupted()
+
+
+def _run_in_child(conn: Connection, task: dict):
+    # own process group, so ffmpeg and other subprocesses of the task are stopped together with it
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, _interrupt)
+    progress.bind(task.get('id'))
+    try:
+        conn.send((True, task['task'](**task['kwargs'])))
+    except BaseException as exc:
+        conn.send((False, f'{exc.__class__.__name__}: {exc}'))
+    finally:
+        conn.close()
+
+
+class WorkerPool:
+    # Every task runs in its own child process, the number of children is bounded per slot
+    # (task function name), so long renders can not take the capacity of short jobs.
+    def __init__(self, limits: dict[str, int], default_limit: int = 1, preload: list[str] | None = None,
+                 timeouts: dict[str, int] | None = None, default_timeout: int | None = None):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self._running: dict[str, int] = defaultdict(int)
+        self._processes: dict[str, multiprocessing.Process] = {}
+        self._cancelled: set[str] = set()
+        # children are forked from a clean server process that has the task modules imported
+        self._context = multiprocessing.get_context('forkserver')
+        self._context.set_forkserver_preload(['__main__', *(preload or [])])
+
+    def limit(self, slot: str) -> int:
+        return self.limits.get(slot, self.default_limit)
+
+    def timeout(self, slot: str) -> int | None:
+        return self.timeouts.get(slot, self.default_timeout)
+
+    def has_capacity(self, slot: str) -> bool:
+        return self._running[slot] < self.limit(slot)
+
+    def running_by_slot(self) -> dict[str, int]:
+        return dict(self._running)
+
+    def running_tasks(self) -> list[str]:
+        return list(self._processes)
+
+    def submit(self, task: dict) -> asyncio.Task:
+        slot = task_slot(task)
+        if not self.has_capacity(slot):
+            raise RuntimeError(f'No free slots for {slot}')
+
+        # the slot is taken right away, before the next admission check
+        self._running[slot] += 1
+        future = asyncio.create_task(self._run_process(task, self.timeout(slot)))
+        future.add_done_callback(lambda _: self._release(slot))
+        return future
+
+    def cancel(self, task_id: str):
+        process = self._processes.get(task_id)
+        if process and task_id not in self._cancelled:
+            self._cancelled.add(task_id)
+            asyncio.create_task(self._stop(process))
+
+    def shutdown(self):
+        for process in self._processes.values():
+            self._signal(process, signal.SIGKILL)
+
+    def _release(self, slot: str):
+        self._running[slot] -= 1
+
+    async def _run_process(self, task: dict, timeout: int | None):
+        task_id = task.get('id')
+        loop = asyncio.get_running_loop()
+        parent_conn, child_conn = self._context.Pipe(duplex=False)
+        process = None
+        readable = loop.create_future()
+        timed_out = False
+        try:
+            try:
+                process = self._context.Process(target=_run_in_child, args=(child_conn, task))
+                process.start()
+            finally:
+                child_conn.close()
+            self._processes[task_id] = process
+            loop.add_reader(parent_conn.fileno(), lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(asyncio.shield(readable), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                await self._stop(process)
+                await readable
+            try:
+                ok, result = parent_conn.recv()
+            except EOFError:
+                ok, result = False, 'Worker process exited unexpectedly'
+        finally:
+            loop.remove_reader(parent_conn.fileno())
+            parent_conn.close()
+            if process is not None and process.pid is not None:
+                await loop.run_in_executor(None, process.join)
+            self._processes.pop(task_id, None)
+
+        if task_id in self._cancelled:
+            self._cancelled.discard(task_id)
+            raise TaskCancelled('Task was cancelled')
+        if timed_out:
+            raise TaskTimedOut(f'Task did not finish in {timeout}s')
+        if not ok:
+            raise TaskFailed(result)
+        return result
+
+    async def _stop(self, process: multiprocessing.Process):
+        self._signal(process, signal.SIGTERM)
+        await asyncio.get_running_loop().run_in_executor(None, process.join, KILL_GRACE_PERIOD)
+        if process.is_alive():
+            self._signal(process, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(process: multiprocessing.Process, signum: int):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            # the child has not created its process group yet
+            try:
+                os.kill(process.pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,85 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+from conf.config import settings
+from utils.video import YouTubeDlOptions, get_youtube_video_info
+
+VIDEO_ID_PATTERN = re.compile(r'^[\w-]{11}$')
+VIDEO_PATH_PREFIXES = ('shorts', 'embed', 'live', 'v', 'e')
+MAX_ENTRIES = 1024
+
+# link -> yt-dlp info dict
+Extractor = Callable[[str], dict]
+
+
+def extract_youtube_info(link: str) -> dict:
+    return get_youtube_video_info(link=link, options=YouTubeDlOptions())
+
+
+def video_id(link: str) -> str:
+    # youtu.be/ID, youtube.com/watch?v=ID, /shorts/ID, /embed/ID ... all name the same video;
+    # links that are not recognized are keyed as they are
+    link = link.strip()
+    if VIDEO_ID_PATTERN.match(link):
+        return link
+    url = urlparse(link if '://' in link else f'https://{link}')
+    host = (url.hostname or '').removeprefix('www.').removeprefix('m.').removeprefix('music.')
+    path = [part for part in url.path.split('/') if part]
+    candidate = None
+    if host == 'youtu.be' and path:
+        candidate = path[0]
+    elif host in ('youtube.com', 'youtube-nocookie.com'):
+        if path[:1] == ['watch']:
+            candidate = parse_qs(url.query).get('v', [None])[0]
+        elif len(path) > 1 and path[0] in VIDEO_PATH_PREFIXES:
+            candidate = path[1]
+    if candidate and VIDEO_ID_PATTERN.match(candidate):
+        return candidate
+    return link
+
+
+class YouTubeMetadata:
+    # yt-dlp lookups take seconds of blocking network I/O, they run on a bounded thread pool so the event loop
+    # keeps serving; results are kept for ttl seconds and concurrent requests for one video share a lookup
+    def __init__(self, extractor: Extractor = extract_youtube_info, ttl: float = settings.YOUTUBE_METADATA_TTL,
+                 max_workers: int = settings.YOUTUBE_METADATA_WORKERS, max_entries: int = MAX_ENTRIES):
+        self.extractor = extractor
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='youtube-metadata')
+        self._cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    async def info(self, link: str) -> dict:
+        key = video_id(link)
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            return cached[1]
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self.extractor, link)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        # a cancelled request must not cancel the lookup the other requests are waiting for
+        return await asyncio.shield(future)
+
+    async def formats(self, link: str) -> list[dict]:
+        data = await self.info(link)
+        return data.get('formats', [data])
+
+    def _finish(self, key: str, future: asyncio.Future):
+        self._in_flight.pop(key, None)
+        # failures are not cached, the next request tries again
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._cache[key] = (time.monotonic() + self.ttl, future.result())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)